@@ -0,0 +1,144 @@
+# ann_config.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Annotator settings, parsed once from annotator_config.ini at startup
+##
+
+import os
+from configparser import ConfigParser, ExtendedInterpolation
+from dataclasses import dataclass, field
+
+'''
+reference:
+    1. configparser: https://docs.python.org/3/library/configparser.html
+    2. dataclasses: https://docs.python.org/3/library/dataclasses.html
+'''
+
+MB = 1024 * 1024
+
+def split_list(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+@dataclass(frozen=True)
+class AnnConfig:
+    cnet_id: str
+    data_path: str
+    region_name: str
+    table_name: str
+    queue_url: str
+
+    #receive policy: the largest batch and the longest long poll
+    max_messages: int = 10
+    wait_time: int = 20
+    #backpressure: stop receiving above this 1-minute load per core, or below
+    #this much free memory / disk (MB), backing off up to backoff_max seconds
+    max_load: float = 1.5
+    min_free_memory: int = 512
+    min_free_disk: int = 1024
+    backoff_max: int = 60
+    #finished messages are acknowledged in batches at most this old (seconds)
+    ack_max_age: float = 1.0
+
+    results_bucket: str = None
+    results_topic: str = None
+    result_index_table: str = None
+
+    concurrent: bool = False
+    workers: int = os.cpu_count() or 1
+    max_children: int = os.cpu_count() or 1
+    job_timeout: int = 0
+
+    engine: str = 'popen'
+    warm_workers: int = os.cpu_count() or 1
+    warm_max_jobs: int = 100
+    warm_preload: list = field(default_factory=lambda: ['driver'])
+    run_script: str = 'run.py'
+    anntools_paths: list = field(default_factory=list)
+
+    shard_min_bytes: int = 0
+    shard_by: str = 'records'
+    shard_records: int = 500000
+
+    download_part_size: int = 8 * MB
+    download_concurrency: int = 10
+    input_cache_bytes: int = 10 * 1024 * MB
+    input_cache_dir: str = None
+
+    annotator_version: str = '1'
+
+    #boto3 connection pool per client (0 = one per transfer thread of every
+    #worker), retry mode/attempts and socket timeouts in seconds
+    aws_max_pool_connections: int = 0
+    aws_retry_mode: str = 'adaptive'
+    aws_max_attempts: int = 5
+    aws_connect_timeout: float = 5
+    aws_read_timeout: float = 60
+
+    #0 / empty turns the scrape endpoint / JSON dump off
+    metrics_port: int = 0
+    metrics_dump_file: str = None
+    metrics_dump_interval: int = 60
+
+    @classmethod
+    def load(cls, path):
+        config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+        config.read(path)
+        return cls.from_parser(config)
+
+    @classmethod
+    def from_parser(cls, config):
+        defaults = cls.__dataclass_fields__
+        get = lambda section, key, name: config.get(section, key, fallback=defaults[name].default)
+        getint = lambda section, key, name: config.getint(section, key, fallback=defaults[name].default)
+
+        data_path = config.get('ann', 'DATA_PATH')
+        workers = config.getint('ann', 'Workers', fallback=defaults['workers'].default)
+        download_concurrency = getint('s3', 'DownloadConcurrency', 'download_concurrency')
+        max_pool = getint('aws', 'MaxPoolConnections', 'aws_max_pool_connections')
+        getfloat = lambda section, key, name: config.getfloat(section, key, fallback=defaults[name].default)
+
+        return cls(cnet_id=config.get('DEFAULT', 'CnetId'),
+                   data_path=data_path,
+                   region_name=config.get('aws', 'AwsRegionName'),
+                   table_name=config.get('db', 'ANN_TABLE'),
+                   queue_url=config.get('sqs', 'QUEUE_URL'),
+                   max_messages=min(10, getint('sqs', 'MaxMessages', 'max_messages')),
+                   wait_time=min(20, getint('sqs', 'WaitTime', 'wait_time')),
+                   max_load=config.getfloat('ann', 'MaxLoad', fallback=defaults['max_load'].default),
+                   min_free_memory=getint('ann', 'MinFreeMemory', 'min_free_memory'),
+                   min_free_disk=getint('ann', 'MinFreeDisk', 'min_free_disk'),
+                   backoff_max=getint('ann', 'BackoffMax', 'backoff_max'),
+                   ack_max_age=config.getfloat('sqs', 'AckMaxAge', fallback=defaults['ack_max_age'].default),
+                   results_bucket=get('s3', 'ResultsBucket', 'results_bucket'),
+                   results_topic=get('sns', 'ResultsTopic', 'results_topic'),
+                   result_index_table=get('db', 'RESULT_INDEX_TABLE', 'result_index_table'),
+                   concurrent=config.getboolean('ann', 'Concurrent', fallback=False),
+                   workers=workers,
+                   max_children=config.getint('ann', 'MaxChildren', fallback=workers),
+                   job_timeout=getint('ann', 'JobTimeout', 'job_timeout'),
+                   engine=get('ann', 'Engine', 'engine'),
+                   warm_workers=config.getint('ann', 'WarmWorkers', fallback=workers),
+                   warm_max_jobs=getint('ann', 'WarmMaxJobs', 'warm_max_jobs'),
+                   warm_preload=split_list(config.get('ann', 'WarmPreload', fallback='driver')),
+                   run_script=get('ann', 'RunScript', 'run_script'),
+                   anntools_paths=split_list(config.get('ann', 'AnnToolsPath', fallback='')),
+                   shard_min_bytes=getint('ann', 'ShardMinBytes', 'shard_min_bytes'),
+                   shard_by=get('ann', 'ShardBy', 'shard_by'),
+                   shard_records=getint('ann', 'ShardRecords', 'shard_records'),
+                   download_part_size=config.getint('s3', 'DownloadPartSize', fallback=8) * MB,
+                   download_concurrency=download_concurrency,
+                   input_cache_bytes=getint('ann', 'InputCacheBytes', 'input_cache_bytes'),
+                   input_cache_dir=config.get('ann', 'InputCacheDir', fallback=data_path + '.cache/'),
+                   annotator_version=get('ann', 'AnnotatorVersion', 'annotator_version'),
+                   aws_max_pool_connections=max_pool or max(10, workers * (download_concurrency + 2)),
+                   aws_retry_mode=get('aws', 'RetryMode', 'aws_retry_mode'),
+                   aws_max_attempts=getint('aws', 'MaxAttempts', 'aws_max_attempts'),
+                   aws_connect_timeout=getfloat('aws', 'ConnectTimeout', 'aws_connect_timeout'),
+                   aws_read_timeout=getfloat('aws', 'ReadTimeout', 'aws_read_timeout'),
+                   metrics_port=getint('ann', 'MetricsPort', 'metrics_port'),
+                   metrics_dump_file=get('ann', 'MetricsDumpFile', 'metrics_dump_file'),
+                   metrics_dump_interval=getint('ann', 'MetricsDumpInterval', 'metrics_dump_interval'))
+
+### EOF
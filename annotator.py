@@ -7,31 +7,99 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
-import boto3
+import aws_clients
 import json
 import os
+import shutil
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from flask import abort
 
-# Get configuration
-from configparser import ConfigParser, ExtendedInterpolation
-
-config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
-config.read("annotator_config.ini")
-
-DATA_PATH = config.get('ann','DATA_PATH')
-s3 = boto3.client('s3')
-cnet_id = config.get('DEFAULT', 'CnetId')
-
-REGION_NAME = config.get('aws','AwsRegionName')
-TABLE_NAME = config.get('db','ANN_TABLE')
-dynamo = boto3.resource('dynamodb', region_name=REGION_NAME)
-ann_table = dynamo.Table(TABLE_NAME)
-sqs = boto3.client('sqs', region_name = REGION_NAME)
-QUEUE_URL = config.get('sqs','QUEUE_URL')
+from input_cache import InputCache
+from metrics import Metrics
+from result_index import ResultIndex, hash_file
+from sqs_ack import BatchAcker
+from sharding import SHARD_CODE, annot_file, log_file, merge_outputs, should_shard, split_vcf
+from supervisor import AnnSupervisor
+from warm_pool import WarmPool
+
+# Get configuration, parsed once into typed settings
+from ann_config import AnnConfig
+from receive_policy import ReceivePolicy
+
+settings = AnnConfig.load("annotator_config.ini")
+
+DATA_PATH = settings.data_path
+cnet_id = settings.cnet_id
+
+REGION_NAME = settings.region_name
+TABLE_NAME = settings.table_name
+#clients are created on first use; the pool covers every concurrent transfer thread
+aws_clients.configure(region_name=REGION_NAME,
+                      max_pool_connections=settings.aws_max_pool_connections,
+                      retry_mode=settings.aws_retry_mode,
+                      max_attempts=settings.aws_max_attempts,
+                      connect_timeout=settings.aws_connect_timeout,
+                      read_timeout=settings.aws_read_timeout)
+s3 = aws_clients.LazyClient('s3')
+dynamo = aws_clients.LazyResource('dynamodb')
+ann_table = aws_clients.table(TABLE_NAME)
+sqs = aws_clients.LazyClient('sqs')
+QUEUE_URL = settings.queue_url
+sns = aws_clients.LazyClient('sns')
+#per-stage latency histograms, tagged by job_id in the log
+metrics = Metrics()
+
+#finished messages are deleted in batches of up to 10 or after AckMaxAge seconds
+acker = BatchAcker(sqs, QUEUE_URL, max_age=settings.ack_max_age,
+                   observe=lambda seconds: metrics.observe('sqs_delete', seconds))
+RESULTS_BUCKET = settings.results_bucket
+RESULTS_TOPIC = settings.results_topic
+
+#concurrent execution mode: number of annotation slots on this instance
+CONCURRENT = settings.concurrent
+WORKERS = settings.workers
+SQS_MAX_BATCH = 10
+
+#sizes each receive to free capacity and backs off while the host is saturated
+policy = ReceivePolicy(settings)
+
+#every anntools child is started, capped, timed out and reaped by the supervisor
+supervisor = AnnSupervisor(max_children=settings.max_children, timeout=settings.job_timeout)
+
+#execution engine for run_anntools: 'popen' starts `python run.py` per job,
+#'warm' hands jobs to a pool of workers with anntools already imported
+ENGINE = settings.engine
+warm_pool = None
+warm_pool_lock = threading.Lock()
+
+#inputs of at least ShardMinBytes are split by 'records' or 'chrom' and
+#annotated in parallel; 0 turns sharding off
+SHARD_MIN_BYTES = settings.shard_min_bytes
+SHARD_BY = settings.shard_by
+SHARD_RECORDS = settings.shard_records
+#returned by annotate() while a sharded job runs in the background
+SHARDING = 'sharding'
+ANNTOOLS_PATHS = settings.anntools_paths
+
+#multi-part, multi-threaded input downloads and a local cache keyed by
+#bucket/key/ETag; InputCacheBytes = 0 turns the cache off
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=settings.download_part_size,
+                                 multipart_chunksize=settings.download_part_size,
+                                 max_concurrency=settings.download_concurrency,
+                                 use_threads=True)
+input_cache = None
+
+#identical inputs reuse the result of an earlier job annotated by the same
+#AnnotatorVersion; no RESULT_INDEX_TABLE turns deduplication off
+result_index = None
+if settings.result_index_table:
+    result_index = ResultIndex(dynamo.Table(settings.result_index_table), settings.annotator_version)
 
 """Reads request messages from SQS and runs AnnTools as a subprocess.
 
@@ -45,11 +113,20 @@ reference：
 def handle_requests_queue(sqs=None):
     rv = {}
 
+    #only take what the engine can start right away
+    policy.wait_for_capacity()
+    max_messages, wait_time = policy.next_receive(free_slots())
+    if not max_messages:
+        time.sleep(1)
+        return 'no free slot'
+
     try: 
         print('Receiving message ...')
-        messages = sqs.receive_message(QueueUrl = QUEUE_URL,
-                            MaxNumberOfMessages= int(config.get('sqs', 'MaxMessages')),
-                            WaitTimeSeconds= int(config.get('sqs', 'WaitTime')))
+        with metrics.timer('sqs_receive'):
+            messages = sqs.receive_message(QueueUrl = QUEUE_URL,
+                                MaxNumberOfMessages= max_messages,
+                                WaitTimeSeconds= wait_time,
+                                AttributeNames= ['SentTimestamp'])
 
     except ClientError as ce:
         print(f'Fail to receive the message {ce}')
@@ -59,6 +136,9 @@ def handle_requests_queue(sqs=None):
         print(f'Unexpected error when receiving message {e}')
         return 'message not found'
 
+    policy.observe(max_messages, len(messages.get('Messages', [])))
+    observe_queue_age(messages.get('Messages', []))
+
     if 'Messages' in messages:
         for message in messages['Messages']:
 
@@ -67,16 +147,182 @@ def handle_requests_queue(sqs=None):
             except Exception as e:
                 print(e)
                 
-            #run anntools
-            response = run_anntools(filename, job_id, user_id)
+            #run anntools; the message stays for redelivery if the job could not be claimed or started
+            try:
+                response = annotate(filename, job_id, user_id,
+                                    on_done=lambda message=message: delete_message(message))
+            except Exception as e:
+                print(f'Fail to annotate {job_id}: {e}')
+                continue
+
+            #delete message; a sharded job deletes its own once it is complete
+            if response != SHARDING:
+                delete_message(message)
+
+
+'''
+reference:
+    1. concurrent.futures: https://docs.python.org/3/library/concurrent.futures.html
+    2. semaphore: https://docs.python.org/3/library/threading.html#semaphore-objects
+'''
+
+def process_message(message):
+    '''
+    Annotate one message end to end, holding its slot until anntools exits
+    input:
+        message: SQS message from the request queue
+    '''
+    try:
+        filename, job_id, user_id = handle_message(message)
+    except Exception as e:
+        print(f'Fail to handle message: {e}')
+        return
+
+    annotate(filename, job_id, user_id, wait=True)
+    delete_message(message)
+
+def run_slot(message, slots):
+    try:
+        process_message(message)
+
+    except Exception as e:
+        print(f'Unexpected error in annotation slot: {e}')
+
+    finally:
+        slots.release()
+
+def run_worker_pool(workers=WORKERS):
+    '''
+    Concurrent execution mode: keep up to `workers` annotations running and
+    only ask SQS for as many messages as there are free slots
+    input:
+        workers: number of annotation slots
+    '''
+    slots = threading.BoundedSemaphore(workers)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    print(f'Running {workers} annotation slots')
+
+    while True:
+        policy.wait_for_capacity()
+
+        #block until at least one slot is free, then grab the rest without waiting
+        slots.acquire()
+        free = 1
+        while free < min(workers, SQS_MAX_BATCH) and slots.acquire(blocking=False):
+            free += 1
+
+        max_messages, wait_time = policy.next_receive(free)
+        for _ in range(free - max_messages):
+            slots.release()
+        free = max_messages
+
+        try:
+            with metrics.timer('sqs_receive'):
+                messages = sqs.receive_message(QueueUrl = QUEUE_URL,
+                                    MaxNumberOfMessages= free,
+                                    WaitTimeSeconds= wait_time,
+                                    AttributeNames= ['SentTimestamp']).get('Messages', [])
+
+        except ClientError as ce:
+            print(f'Fail to receive the message {ce}')
+            messages = []
+
+        except Exception as e:
+            print(f'Unexpected error when receiving message {e}')
+            messages = []
+
+        policy.observe(free, len(messages))
+        observe_queue_age(messages)
+
+        #give back the slots nothing arrived for
+        for _ in range(free - len(messages)):
+            slots.release()
 
-            #delete message
-            delete_message(message)
+        for message in messages:
+            executor.submit(run_slot, message, slots)
 
+def get_warm_pool():
+    '''
+    Start the warm pool on first use; never at import, since the pool's
+    workers import this module again
+    '''
+    global warm_pool
+    with warm_pool_lock:
+        if warm_pool is None:
+            warm_pool = WarmPool(workers=settings.warm_workers,
+                                 max_jobs=settings.warm_max_jobs,
+                                 script=settings.run_script,
+                                 preload=settings.warm_preload,
+                                 paths=ANNTOOLS_PATHS,
+                                 timeout=supervisor.timeout,
+                                 supervisor=supervisor)
+    return warm_pool
+
+def observe_queue_age(messages):
+    #time each message spent in the queue before this receive
+    now = time.time()
+    for message in messages:
+        sent = message.get('Attributes', {}).get('SentTimestamp')
+        if sent:
+            metrics.observe('queue_age', max(0.0, now - int(sent) / 1000))
+
+def in_flight():
+    running = len(supervisor.running)
+    if warm_pool is not None:
+        running += warm_pool.in_flight
+    return running
+
+def start_metrics():
+    '''
+    MetricsPort serves /metrics and /metrics.json on localhost;
+    MetricsDumpFile gets a JSON snapshot every MetricsDumpInterval seconds
+    '''
+    metrics.gauge('in_flight_jobs', in_flight)
+    metrics.gauge('supervisor_free_slots', supervisor.free)
+    metrics.gauge('acks_pending', lambda: acker.stats()['pending'])
+    metrics.gauge('aws_client_init_seconds', lambda: aws_clients.startup_report()['seconds'])
+    if result_index:
+        metrics.gauge('result_index_hit_rate', lambda: result_index.stats()['hit_rate'])
+    if input_cache:
+        metrics.gauge('input_cache_bytes', lambda: input_cache.stats()['bytes'])
+
+    if settings.metrics_port:
+        metrics.serve(settings.metrics_port)
+    if settings.metrics_dump_file:
+        metrics.dump_every(settings.metrics_dump_file, settings.metrics_dump_interval)
+
+def free_slots():
+    if ENGINE == 'warm':
+        return get_warm_pool().free()
+    return supervisor.free()
+
+def start_input_cache():
+    '''
+    Open the input cache from main(); warm pool workers import this module
+    too and must not touch the cache folder
+    '''
+    global input_cache
+    if settings.input_cache_bytes:
+        input_cache = InputCache(s3, settings.input_cache_dir, settings.input_cache_bytes,
+                                 transfer_config=TRANSFER_CONFIG)
 
 def main():
 
+    start_input_cache()
+    start_metrics()
+
+    #start the warm workers before the first message arrives
+    if ENGINE == 'warm':
+        get_warm_pool()
+
+    #the queue client is needed right away; the others come with the first job
+    sqs.meta
+    print(json.dumps({'event': 'startup', 'aws_clients': aws_clients.startup_report()}))
+
     # Get handles to queue
+    if CONCURRENT:
+        run_worker_pool()
+        return
 
     # Poll queue for new results and process them
     while True:
@@ -129,9 +375,14 @@ def handle_message(message):
 
     filename =  folder_path + file_name
 
-    #download file from s3
+    #download file from s3, unless an earlier delivery already cached it
     try:
-        s3.download_file(bucket, key, filename)
+        with metrics.timer('s3_download', job_id):
+            if input_cache:
+                if input_cache.fetch(bucket, key, filename):
+                    print(f'{job_id} input found in local cache')
+            else:
+                s3.download_file(bucket, key, filename, Config=TRANSFER_CONFIG)
 
     except ClientError as fe:
         rv['Code'] = 500
@@ -147,62 +398,303 @@ def handle_message(message):
 
     return filename, job_id, user_id
 
-def run_anntools(filename, job_id, user_id):
+def run_anntools(filename, job_id, user_id, wait=False, on_exit=None):
     '''
     Run anntools and update job status
     input:
         filename: name of file in local document
         job_id: job_id of the file
+        wait: block until anntools exits (used by the concurrent slots)
+        on_exit: called with the job's resource record once anntools exits
     output:
         rv: result of running anntools
     '''
     rv = {'code': None, 'status': None}
+    child = None
+    on_exit = timed_exit(on_exit)
 
-    #running anntools
+    #running anntools, the popen engine waits here while the supervisor is at its cap;
+    #annotate() has already moved the job to RUNNING
     try:
-        p = Popen(['python', 'run.py', filename, job_id])
+        with metrics.timer('process_spawn', job_id):
+            if ENGINE == 'warm':
+                child = get_warm_pool().submit(filename, job_id, on_exit=on_exit)
+            else:
+                child = supervisor.submit(['python', 'run.py', filename, job_id], job_id, on_exit=on_exit)
 
     except Exception as e:
-        print('Fail to run anntools')
+        #hand the job back so the redelivered message can claim it again
+        print(f'Fail to run anntools: {e}')
+        release_job(job_id)
+        raise
 
-    #updating and checking status
+    if wait and child is not None:
+        child.wait()
+
+    rv['Code'] = 200
+    rv['status'] = 'success'
+    rv['data'] = {}
+    rv['data']['job_id'] = job_id
+    rv['data']['input_file'] = filename.replace(cnet_id, '')
+
+
+    return json.dumps(rv), 200
+
+def timed_exit(on_exit):
+    #feed the anntools wall time into the stage histograms before on_exit
+    def record_exit(record):
+        if record.get('wall_time') is not None:
+            metrics.observe('anntools', record['wall_time'], record['job_id'])
+        if on_exit:
+            on_exit(record)
+    return record_exit
+
+def set_running(job_id):
+    '''
+    Claim a job by moving it from PENDING to RUNNING
+    output:
+        claimed: False when another delivery already started it; other
+                 errors are raised so the message is not deleted
+    '''
     try:
-        ann_table.update_item(Key = {"job_id": job_id},
-                          UpdateExpression = 'SET job_status = :st',
-                          ConditionExpression="job_status = :pd",
-                          ExpressionAttributeValues={":st": 'RUNNING', ":pd": "PENDING"})
+        with metrics.timer('dynamo_update', job_id):
+            ann_table.update_item(Key = {"job_id": job_id},
+                              UpdateExpression = 'SET job_status = :st',
+                              ConditionExpression="job_status = :pd",
+                              ExpressionAttributeValues={":st": 'RUNNING', ":pd": "PENDING"})
 
     except ClientError as err:
         if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            print(f'File already annotated')
+            print(f'{job_id} already started, skipped')
+            return False
+        raise
+
+    return True
+
+def release_job(job_id):
+    #undo set_running when nothing was started
+    try:
+        ann_table.update_item(Key = {"job_id": job_id},
+                              UpdateExpression = 'SET job_status = :pd',
+                              ConditionExpression="job_status = :st",
+                              ExpressionAttributeValues={":st": 'RUNNING', ":pd": "PENDING"})
 
-        else:
-            print(f'{err}')
+    except ClientError as err:
+        print(f'Fail to release {job_id}: {err}')
+
+def annotate(filename, job_id, user_id, wait=False, on_done=None):
+    '''
+    Stages between handle_message and run_anntools: inputs seen before are
+    completed from the result index, large inputs are split, annotated in
+    parallel and merged, the rest go to run_anntools
+    input:
+        filename: name of file in local document
+        job_id: job_id of the file
+        wait: block until the annotation is done
+        on_done: for a sharded job left running in the background, called
+                 once it is complete; annotate then returns SHARDING and the
+                 caller leaves its message to on_done
+    '''
+    #claim the job before anything runs, so a redelivered or re-published
+    #message for a job that is already started is dropped here
+    if not set_running(job_id):
+        return
+
+    digest = None
+    if result_index:
+        try:
+            digest = hash_file(filename)
+        except OSError as oe:
+            print(f'Fail to hash input: {oe}')
+
+    if digest:
+        item = result_index.lookup(digest)
+        print(json.dumps({'event': 'result_index', 'job_id': job_id, 'hit': bool(item), **result_index.stats()}))
+        if item and complete_from_index(job_id, user_id, filename, item):
+            return
+        if item:
+            result_index.forget(digest)
+
+    try:
+        shard = should_shard(filename, SHARD_MIN_BYTES)
+    except OSError as oe:
+        print(f'Fail to check input size: {oe}')
+        shard = False
+
+    if not shard:
+        on_exit = None
+        if digest:
+            on_exit = lambda record: index_result(record, digest, job_id, user_id, filename)
+        return run_anntools(filename, job_id, user_id, wait=wait, on_exit=on_exit)
+
+    if wait:
+        return run_sharded(filename, job_id, user_id, digest)
+
+    threading.Thread(target=run_sharded_in_background, args=(filename, job_id, user_id, digest, on_done),
+                     daemon=True).start()
+    return SHARDING
+
+def index_result(record, digest, job_id, user_id, filename):
+    #run.py uploaded the results under the usual keys if anntools succeeded
+    if record['returncode'] == 0:
+        result_index.record(digest, RESULTS_BUCKET,
+                            s3_result_key(job_id, user_id, annot_file(filename)),
+                            s3_result_key(job_id, user_id, log_file(filename)), job_id)
+
+'''
+reference:
+    1. managed copy: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html
+'''
+
+def complete_from_index(job_id, user_id, filename, item):
+    '''
+    Complete a job by copying the outputs of an earlier job with the same input
+    output:
+        done: False when the earlier outputs are gone and anntools has to run
+    '''
+    result_key = s3_result_key(job_id, user_id, annot_file(filename))
+    log_key = s3_result_key(job_id, user_id, log_file(filename))
+
+    try:
+        s3.copy({'Bucket': item['s3_results_bucket'], 'Key': item['s3_key_result_file']}, RESULTS_BUCKET, result_key)
+        s3.copy({'Bucket': item['s3_results_bucket'], 'Key': item['s3_key_log_file']}, RESULTS_BUCKET, log_key)
+
+    except ClientError as ce:
+        print(f'Fail to copy indexed result for {job_id}: {ce}')
+        return False
 
     except Exception as e:
-        print(f'Unexpected Error: {e}')
+        print(f'Unexpected error when copying indexed result for {job_id}: {e}')
+        return False
 
-    rv['Code'] = 200
-    rv['status'] = 'success'
-    rv['data'] = {}
-    rv['data']['job_id'] = job_id
-    rv['data']['input_file'] = filename.replace(cnet_id, '')
+    print(f'{job_id} reuses the result of {item["job_id"]}')
+    return mark_completed(job_id, user_id, result_key, log_key)
 
+def run_sharded(filename, job_id, user_id, digest=None, on_done=None):
+    '''
+    Annotate a large input as parallel shards under the supervisor, then merge
+    them into one result file and one log and complete the job. On failure
+    the job is handed back (RUNNING to PENDING) and the error raised, like
+    run_anntools, so its message is not deleted and comes back
+    input:
+        on_done: called once the job is complete
+    '''
+    shard_dir = os.path.join(os.path.dirname(filename), 'shards')
 
-    return json.dumps(rv), 200
+    try:
+        shards = split_vcf(filename, shard_dir, by=SHARD_BY, records_per_shard=SHARD_RECORDS)
+        print(f'{job_id} split into {len(shards)} shards')
 
-def delete_message(message):
-    
-    receipt_handle = message['ReceiptHandle']
+        #submit blocks while the supervisor is at its cap, so shards share the slots
+        children = [supervisor.submit(['python', '-c', SHARD_CODE, shard] + ANNTOOLS_PATHS, f'{job_id}:{i}')
+                    for i, shard in enumerate(shards)]
+        failed = [child.job_id for child in children if child.wait()['returncode'] != 0]
+        if failed:
+            raise RuntimeError(f'shards {failed} failed')
+
+        if shards:
+            result_file, log = merge_outputs(shards, filename)
+
+    except OSError as oe:
+        print(f'Fail to shard {job_id}: {oe}')
+        release_job(job_id)
+        raise
+
+    except Exception as e:
+        print(f'Fail to annotate {job_id} in shards: {e}')
+        release_job(job_id)
+        raise
+
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    #a header-only input has no records to split, so it runs whole
+    if not shards:
+        on_exit = None
+        if digest:
+            on_exit = lambda record: index_result(record, digest, job_id, user_id, filename)
+        run_anntools(filename, job_id, user_id, wait=True, on_exit=on_exit)
+
+    elif complete_job(job_id, user_id, result_file, log):
+        if digest:
+            result_index.record(digest, RESULTS_BUCKET, s3_result_key(job_id, user_id, result_file),
+                                s3_result_key(job_id, user_id, log), job_id)
+
+    else:
+        release_job(job_id)
+        raise RuntimeError(f'Fail to complete {job_id}')
+
+    if on_done:
+        on_done()
+
+def run_sharded_in_background(filename, job_id, user_id, digest, on_done):
+    try:
+        run_sharded(filename, job_id, user_id, digest, on_done)
+    except Exception as e:
+        #the message is left to come back
+        print(f'Fail to annotate {job_id}: {e}')
+
+'''
+reference:
+    1. upload file: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_file.html
+'''
+
+def s3_result_key(job_id, user_id, local_file):
+    return f'{cnet_id}/{user_id}/{job_id}~{os.path.basename(local_file)}'
+
+def complete_job(job_id, user_id, result_file, log):
+    '''
+    Upload results, mark the job COMPLETED and notify the results topic,
+    the same way run.py finishes an unsharded job
+    '''
+    result_key = s3_result_key(job_id, user_id, result_file)
+    log_key = s3_result_key(job_id, user_id, log)
 
     try:
-        sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=receipt_handle)
+        s3.upload_file(result_file, RESULTS_BUCKET, result_key)
+        s3.upload_file(log, RESULTS_BUCKET, log_key)
 
     except ClientError as ce:
-        print(f'Fail to delete message: {ce}')
+        print(f'Fail to upload results of {job_id}: {ce}')
+        return False
 
     except Exception as e:
-        print(f'Unexpected error: {e}')
+        print(f'Unexpected error when uploading results of {job_id}: {e}')
+        return False
+
+    return mark_completed(job_id, user_id, result_key, log_key)
+
+def mark_completed(job_id, user_id, result_key, log_key):
+    try:
+        ann_table.update_item(Key = {"job_id": job_id},
+                          UpdateExpression = 'SET job_status = :st, s3_results_bucket = :b, '
+                                             's3_key_result_file = :r, s3_key_log_file = :l, complete_time = :t',
+                          ExpressionAttributeValues={":st": 'COMPLETED', ":b": RESULTS_BUCKET,
+                                                     ":r": result_key, ":l": log_key, ":t": int(time.time())})
+
+        sns.publish(TopicArn = RESULTS_TOPIC,
+                    Message = json.dumps({'job_id': job_id, 'user_id': user_id,
+                                          's3_result_bucket': RESULTS_BUCKET,
+                                          's3_key_result_file': result_key}))
+
+    except ClientError as ce:
+        print(f'Fail to complete job {job_id}: {ce}')
+        return False
+
+    except Exception as e:
+        print(f'Unexpected error when completing job {job_id}: {e}')
+        return False
+
+    print(f'{job_id} completed')
+    return True
+
+def delete_message(message):
+    
+    receipt_handle = message['ReceiptHandle']
+
+    #queued for the next delete_message_batch; the batch call itself is timed
+    #as sqs_delete by the acker
+    acker.ack(receipt_handle)
 
 
 if __name__ == "__main__":
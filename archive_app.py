@@ -7,11 +7,15 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
-import boto3
+import atexit
+import aws_clients
 import json
 import requests
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 from flask import Flask, request, jsonify
 
@@ -23,22 +27,89 @@ app.url_map.strict_slashes = False
 environment = "archive_app_config.Config"
 app.config.from_object(environment)
 REGION_NAME = app.config["AWS_REGION_NAME"]
-s3_client = boto3.client('s3', region_name = REGION_NAME)
-glacier_client = boto3.client('glacier', region_name = REGION_NAME)
-dynamo = boto3.resource('dynamodb', region_name=REGION_NAME)
-ann_table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-sns_client = boto3.client('sns', region_name = REGION_NAME)
-sqs_client = boto3.client('sqs', region_name = REGION_NAME)
+#clients are created on first use, sized and retried per AWS_* settings in the config
+aws_clients.configure(**aws_clients.from_mapping(app.config))
+s3_client = aws_clients.LazyClient('s3')
+glacier_client = aws_clients.LazyClient('glacier')
+ann_table = aws_clients.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+sns_client = aws_clients.LazyClient('sns')
+sqs_client = aws_clients.LazyClient('sqs')
 WAIT_TIME = int(app.config["WAIT_TIME"])
 MAX_MESSAGE = int(app.config["MAX_MESSAGE"])
 
 sys.path.append(app.config['HOME_PATH'])
 from gas.util.helpers import get_user_profile
 from botocore.exceptions import ClientError
-
-sys.path.append(app.config['HOME_PATH'])
-from gas.util.helpers import get_user_profile
-from botocore.exceptions import ClientError
+from sqs_ack import BatchAcker
+from glacier_upload import GlacierUploader, MB
+from archive_pack import ArchivePacker, Member, PackBody
+from archive_worker import ArchiveWorker
+from archive_schedule import ArchiveScheduler
+from tier_cache import TierCache, accounts_roles, one_by_one
+import result_codec
+
+#user tiers are cached for TIER_CACHE_TTL seconds and dropped when view.py
+#publishes a role change to /tier; misses of concurrent messages share one
+#query of ACCOUNTS_DATABASE, or fall back to get_user_profile per user
+tiers = TierCache(accounts_roles(app.config['ACCOUNTS_DATABASE']) if app.config.get('ACCOUNTS_DATABASE')
+                  else one_by_one(get_user_profile),
+                  ttl=int(app.config.get('TIER_CACHE_TTL', 300)),
+                  maxsize=int(app.config.get('TIER_CACHE_SIZE', 65536)))
+
+#processed result messages are deleted in batches
+acker = BatchAcker(sqs_client, app.config['AWS_SQS_JOB_RESULT'],
+                   max_age=float(app.config.get('ACK_MAX_AGE', 1.0)))
+
+#results stream into Glacier multipart uploads of GLACIER_PART_SIZE_MB parts,
+#GLACIER_UPLOAD_CONCURRENCY at a time
+uploader = GlacierUploader(glacier_client, app.config['AWS_GLACIER_VAULT'],
+                           part_size=int(app.config.get('GLACIER_PART_SIZE_MB', 8)) * MB,
+                           concurrency=int(app.config.get('GLACIER_UPLOAD_CONCURRENCY', 4)))
+
+#every result is compressed with ARCHIVE_CODEC (none, gzip or zstd) on its way
+#to glacier; ratio and throughput of each archive are logged and totalled
+CODEC = app.config.get('ARCHIVE_CODEC', 'gzip')
+CODEC_LEVEL = app.config.get('ARCHIVE_COMPRESSION_LEVEL')
+result_codec.check(CODEC)
+archive_totals = {'archives': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'seconds': 0.0}
+totals_lock = threading.Lock()
+
+#a free user's results are packed into one archive once the oldest has waited
+#PACK_WINDOW seconds or they reach PACK_MAX_MB; the result queue's visibility
+#timeout must be longer than the window
+packer = ArchivePacker(lambda user_id, members: archive(user_id, members),
+                       window=int(app.config.get('PACK_WINDOW', 60)),
+                       max_bytes=int(app.config.get('PACK_MAX_MB', 256)) * MB,
+                       concurrency=int(app.config.get('PACK_CONCURRENCY', 2)))
+
+#the result queue is consumed by ARCHIVE_WORKERS threads, started by the first
+#POST to /archive (or by running this file); failed messages come back after
+#ARCHIVE_RETRY_BASE seconds, doubling, until ARCHIVE_MAX_RECEIVES
+worker = ArchiveWorker(sqs_client, app.config['AWS_SQS_JOB_RESULT'],
+                       lambda mes: handle_result_message(mes), acker,
+                       workers=int(app.config.get('ARCHIVE_WORKERS', 4)),
+                       wait_time=WAIT_TIME,
+                       max_rate=float(app.config.get('ARCHIVE_MAX_RATE', 0)),
+                       retry_base=int(app.config.get('ARCHIVE_RETRY_BASE', 30)),
+                       max_receives=int(app.config.get('ARCHIVE_MAX_RECEIVES', 5)))
+
+#with ARCHIVE_SCHEDULE_DB set, the result queue subscribes to the results topic
+#directly and each result waits ARCHIVE_DELAY seconds in that local file instead
+#of in the state machine; due results fire ARCHIVE_SCHEDULE_BATCH at a time
+ARCHIVE_DELAY = int(app.config.get('ARCHIVE_DELAY', 180))
+scheduler = None
+if app.config.get('ARCHIVE_SCHEDULE_DB'):
+    scheduler = ArchiveScheduler(app.config['ARCHIVE_SCHEDULE_DB'], lambda due: archive_due(due),
+                                 lease=int(app.config.get('ARCHIVE_SCHEDULE_LEASE', 600)),
+                                 batch=int(app.config.get('ARCHIVE_SCHEDULE_BATCH', 500)))
+    schedule_pool = ThreadPoolExecutor(max_workers=int(app.config.get('ARCHIVE_WORKERS', 4)))
+
+@atexit.register
+def shutdown():
+    #archive what is pending instead of waiting for SQS to redeliver it
+    worker.stop(timeout=WAIT_TIME + 5)
+    packer.flush_all()
+    acker.flush()
 
 @app.route("/", methods=["GET"])
 def home():
@@ -48,118 +119,205 @@ def home():
 reference:
     1. subscribe:https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/subscribe.html
         https://docs.aws.amazon.com/sns/latest/dg/SendMessageToHttp.prepare.html
-    2. glacier: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_archive.html
+    2. glacier: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_multipart_upload.html
     3. delete from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_object.html
     4. state machine: https://docs.aws.amazon.com/step-functions/latest/dg/tutorial-creating-lambda-state-machine.html
 '''
 
 @app.route("/archive", methods=["POST"])
 def archive_free_user_data():
-    print('searching...')
+    #only a trigger: the worker polls the result queue on its own once started
+    if worker.start():
+        print('archive worker started')
+    if scheduler:
+        scheduler.start()
+    return jsonify(worker.stats())
+
+@app.route("/archive/stats", methods=["GET"])
+def archive_stats():
+    with totals_lock:
+        totals = dict(archive_totals)
+    totals['ratio'] = round(totals['raw_bytes'] / totals['stored_bytes'], 3) if totals['stored_bytes'] else None
+    return jsonify({'worker': worker.stats(), 'packer': packer.stats(), 'acker': acker.stats(),
+                    'tiers': tiers.stats(), 'archives': totals,
+                    'schedule': scheduler.stats() if scheduler else None})
+
+@app.route("/tier", methods=["POST"])
+def tier_changed():
+    #sns http subscription to the role change topic
+    post_req = json.loads(request.data)
+
+    if post_req.get('Type') == 'SubscriptionConfirmation':
+        sns_client.confirm_subscription(TopicArn=post_req.get('TopicArn'), Token=post_req.get('Token'))
+
+    elif post_req.get('Type') == 'Notification':
+        user_id = json.loads(post_req.get('Message')).get('user_id')
+        tiers.invalidate(user_id)
+        print('tier dropped', user_id)
+
+    return jsonify('ok')
+
+def handle_result_message(mes):
+    '''
+    Handle one message of the result queue
+    output:
+        True when it can be acknowledged now, False when its pack acknowledges it
+    '''
+    post_req = json.loads(mes['Body'])
+    print(post_req)
+
+    if post_req.get('Type') == 'SubscriptionConfirmation':
+        topicArn = post_req.get('TopicArn')
+        token = post_req.get('Token')
+        sns_client.confirm_subscription(TopicArn=topicArn, Token=token)
+        return True
+
+    if post_req.get('Type') != 'Notification':
+        return True
+
+    message = json.loads(post_req.get('Message'))
+    if not message:
+        return True
+
+    #held locally until due; the message is done once the schedule has it
+    if scheduler:
+        scheduler.schedule(message['job_id'], message, sent_time(post_req) + ARCHIVE_DELAY)
+        return True
+
+    result_file = message['s3_key_result_file']
+    result_bucket = message["s3_result_bucket"]
+    user_id = message['user_id']
+    user_type = tiers.get(user_id)
+
+    #archive for free user: queued for the user's next pack, and
+    #acknowledged once that pack is in glacier
+    if user_type != 'free_user':
+        return True
+
+    if not queue_for_archive(message, result_bucket, result_file, mes['ReceiptHandle']):
+        return True
+    print('queued for archive')
+    return False
+
+def sent_time(post_req):
+    #when sns took the result, so a redelivered message is not delayed again
     try:
-        messages = sqs_client.receive_message(QueueUrl = app.config['AWS_SQS_JOB_RESULT'],
-                            WaitTimeSeconds= WAIT_TIME,
-                            MaxNumberOfMessages= MAX_MESSAGE)
-
-    except Exception as e:
-        raise Exception(f'Error when receiving message')
-    
-    if 'Messages' in messages:
-        for mes in messages['Messages']:
-            post_req = json.loads(mes['Body'])
-            print(post_req)
-    
-        if post_req.get('Type') == 'SubscriptionConfirmation':
-                topicArn = post_req.get('TopicArn')
-                token = post_req.get('Token')
-                sns_client.confirm_subscription(TopicArn=topicArn, Token=token)
-
-        elif post_req.get('Type') == 'Notification':
-            message = json.loads(post_req.get('Message'))
-
-            if message:
-                result_file = message['s3_key_result_file']
-                result_bucket = message["s3_result_bucket"]
-                user_id = message['user_id']
-                profile = get_user_profile(user_id)
-                user_type = profile[4]
-
-                #archive for free user
-                if user_type == 'free_user':
-                    try:
-                        archive_id, upload = archive(result_bucket, result_file)
-                        if upload:
-                            clean_up(message, result_bucket, result_file, archive_id)
-                        print('archive completed')
-                    except Exception as e:
-                        print(f'error: {e}')
-
-                receipt_handle = mes['ReceiptHandle']
-                try:
-                    sqs_client.delete_message(QueueUrl=app.config['AWS_SQS_JOB_RESULT'], ReceiptHandle=receipt_handle)
-
-                except ClientError as ce:
-                    print(f'Fail to delete message: {ce}')
-
-                except Exception as e:
-                    print(f'Unexpected error: {e}')
-                
-                print('completed')
-
-    return jsonify('hi')
-
-def archive(result_bucket, result_file):
-    upload = False
-    #get input file from s3
+        sent = datetime.strptime(post_req['Timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        return sent.replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, ValueError):
+        return time.time()
+
+def archive_due(entries):
+    '''
+    Fired by the scheduler with a batch of due (job_id, message)
+    '''
+    #one tier lookup for the whole batch; tiers are read when due, so an
+    #upgrade while waiting keeps the result in s3
+    user_tiers = tiers.get_many([message['user_id'] for _, message in entries])
+    kept = [job_id for job_id, message in entries if user_tiers.get(message['user_id']) != 'free_user']
+    if kept:
+        scheduler.done(kept)
+    list(schedule_pool.map(queue_scheduled, [message for job_id, message in entries if job_id not in kept]))
+
+def queue_scheduled(message):
+    #no receipt handle: the entry leaves the schedule once its pack is archived,
+    #and fires again after the lease if that never happens
     try:
-        print(result_bucket, result_file)
-        s3_file = s3_client.get_object(Bucket = result_bucket,
-                                Key = result_file)
-        body = s3_file['Body'].read()
-        if body:
-            upload = True
-
-    except ClientError as err:
-        print(f'Fail to update data: {err}')
-        return err
-
-    except Exception as e:
-        print(f'Unexpected error when getting input: {e}')
-        return err
-
-    #upload to glacier
-    try: 
-        gla_response = glacier_client.upload_archive(vaultName = app.config['AWS_GLACIER_VAULT'], body=body)
-        archive_id = gla_response['archiveId']
-        print(f'{result_file} archived, archive id {archive_id}')
-
-    except ClientError as err:
-        raise ClientError(f'Fail to update data: {err}')
-
+        if not queue_for_archive(message, message['s3_result_bucket'], message['s3_key_result_file'], None):
+            scheduler.done([message['job_id']])
     except Exception as e:
-        raise Exception(f'Unexpected error: {e}')
-
-    return archive_id, upload
-
-
-def clean_up(message, result_bucket, result_file, archive_id):
-    #update DynamoDB
-    print(message['job_id'],archive_id)
+        print(f'Fail to queue scheduled archive of {message.get("job_id")}: {e}')
+
+def queue_for_archive(message, result_bucket, result_file, receipt_handle):
+    '''
+    output:
+        False when an earlier delivery already archived the result, so there
+        is nothing to queue and the message can be acknowledged
+    '''
+    #the size decides when a pack is full
     try:
-        ann_table.update_item(Key = {"job_id": message['job_id']},
-                                UpdateExpression = 'SET results_file_archive_id =:a_id',
-                                ExpressionAttributeValues={":a_id": archive_id})
+        size = s3_client.head_object(Bucket = result_bucket, Key = result_file)['ContentLength']
 
     except ClientError as err:
-        raise ClientError(f'Fail to update data: {err}')
-
-    except Exception as e:
-        raise Exception(f'Unexpected error: {e}')
+        #gone from s3: archived and deleted by an earlier delivery, or really missing
+        if err.response['Error']['Code'] not in ('404', 'NoSuchKey') or not already_archived(message['job_id']):
+            raise
+        print(f"{message['job_id']} already archived")
+        return False
+
+    packer.add(message['user_id'], Member(message['job_id'], result_bucket, result_file, size, receipt_handle))
+    return True
+
+def already_archived(job_id):
+    response = ann_table.get_item(Key = {'job_id': job_id},
+                                  ProjectionExpression = 'results_file_archive_id',
+                                  ConsistentRead = True)
+    return 'results_file_archive_id' in response.get('Item', {})
+
+def archive(user_id, members):
+    #stream every member from s3 back to back into one glacier archive
+    body = PackBody(s3_client, members, codec=CODEC, level=CODEC_LEVEL)
+    start = time.perf_counter()
+    try: 
+        archive_id, size, checksum = uploader.upload(body, description=f'pack {user_id} {len(members)} results')
+        if archive_id is not None:
+            print(f'{len(members)} results of {user_id} archived, archive id {archive_id}, {size} bytes')
+            record_archive(user_id, archive_id, body, size, time.perf_counter() - start)
+
+    finally:
+        body.close()
+
+    scheduled = []
+    for member in members:
+        #offset None: gone from s3 (already archived by an earlier delivery); nothing to keep
+        #archive_id None: every member was empty, so nothing went to glacier and the results stay in s3
+        if member.offset is not None and archive_id is not None:
+            try:
+                clean_up(member, archive_id, size, CODEC)
+
+            except Exception as e:
+                #left unacknowledged, so only this result comes back and is archived again
+                print(f'Fail to record {member.job_id} in archive {archive_id}: {e}')
+                continue
+
+        if member.receipt_handle is None:
+            scheduled.append(member.job_id)
+        else:
+            acker.ack(member.receipt_handle)
+    if scheduled:
+        scheduler.done(scheduled)
+
+
+def record_archive(user_id, archive_id, body, size, seconds):
+    #bytes drive glacier storage and retrieval cost, so every archive reports its ratio
+    ratio = round(body.raw_bytes / size, 3) if size else None
+    print(json.dumps({'event': 'archive', 'user_id': user_id, 'archive_id': archive_id, 'codec': CODEC,
+                      'members': len(body.members), 'raw_bytes': body.raw_bytes, 'stored_bytes': size,
+                      'ratio': ratio, 'seconds': round(seconds, 3),
+                      'compress_seconds': round(body.compress_seconds, 3),
+                      'raw_mb_per_s': round(body.raw_bytes / MB / seconds, 2) if seconds else None}))
+    with totals_lock:
+        archive_totals['archives'] += 1
+        archive_totals['raw_bytes'] += body.raw_bytes
+        archive_totals['stored_bytes'] += size
+        archive_totals['seconds'] += seconds
+
+def clean_up(member, archive_id, archive_size, codec='none'):
+    #update DynamoDB with where the member sits in its pack and how it is stored
+    print(member.job_id, archive_id, member.offset, member.length)
+    #a failed update is raised, so the result stays in s3 until it is recorded
+    ann_table.update_item(Key = {"job_id": member.job_id},
+                            UpdateExpression = 'SET results_file_archive_id =:a_id, archive_offset =:o, '
+                                               'archive_length =:l, archive_size =:s, '
+                                               'archive_codec =:c, archive_raw_length =:r',
+                            ExpressionAttributeValues={":a_id": archive_id, ":o": member.offset,
+                                                       ":l": member.length, ":s": archive_size,
+                                                       ":c": codec, ":r": member.raw_length})
 
     #delete file from s3
     try:
-        s3_client.delete_object(Bucket = result_bucket,
-                            Key = result_file)
+        s3_client.delete_object(Bucket = member.bucket,
+                            Key = member.key)
 
     except ClientError as err:
         print(f'Fail to delete data: {err}')
@@ -167,4 +325,10 @@ def clean_up(message, result_bucket, result_file, archive_id):
     except Exception as e:
         print(f'Unexpected error when deleting: {e}')
 
+if __name__ == '__main__':
+    #worker only, without the webhook
+    if scheduler:
+        scheduler.start()
+    worker.run()
+
 ### EOF
\ No newline at end of file
@@ -0,0 +1,194 @@
+# archive_pack.py
+#
+# Packs each free user's results into one Glacier archive: results are
+# grouped per user until the oldest has waited a time window or the group
+# reaches a size limit, then streamed back to back into a single archive.
+# Every member's byte offset and length are kept so it can be restored on
+# its own with a range retrieval. With a codec, every member is compressed
+# on its own and offsets and lengths count compressed bytes.
+##
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from result_codec import CompressedReader
+
+'''
+reference:
+    1. range retrieval: https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html#downloading-an-archive-range
+    2. initiate job: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_job.html
+'''
+
+MB = 1024 * 1024
+
+def aligned_range(offset, length, archive_size):
+    '''
+    Smallest megabyte-aligned byte range of an archive holding one member,
+    as Glacier's RetrievalByteRange wants it
+    output:
+        'start-end', or None when that is the whole archive
+    '''
+    start = offset // MB * MB
+    end = min(archive_size, -(-(offset + length) // MB) * MB) - 1
+    if start == 0 and end == archive_size - 1:
+        return None
+    return f'{start}-{end}'
+
+
+class Member:
+    def __init__(self, job_id, bucket, key, size, receipt_handle=None):
+        self.job_id = job_id
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.receipt_handle = receipt_handle
+        #set once the member has been read into its pack
+        self.offset = None
+        self.length = None
+        self.raw_length = None
+
+
+class PackBody:
+    '''
+    File-like concatenation of the members' S3 objects, opened one at a time;
+    records each member's offset and length in the pack as it is read.
+    Members whose object is gone are skipped and keep offset None.
+    input:
+        codec: result_codec codec each member is compressed with
+        level: compression level, None for the codec's default
+    '''
+    def __init__(self, s3, members, codec='none', level=None):
+        self.s3 = s3
+        self.members = list(members)
+        self.codec = codec
+        self.level = level
+        self.index = -1
+        self.body = None
+        self.position = 0
+        self.raw_bytes = 0
+        self.compress_seconds = 0.0
+
+    def next_body(self):
+        if self.body is not None:
+            self.body.close()
+            member = self.members[self.index]
+            member.length = self.position - member.offset
+            member.raw_length = self.body.raw_bytes if self.codec != 'none' else member.length
+            self.raw_bytes += member.raw_length
+            self.compress_seconds += getattr(self.body, 'seconds', 0.0)
+        self.body = None
+
+        while self.body is None and self.index + 1 < len(self.members):
+            self.index += 1
+            member = self.members[self.index]
+            try:
+                self.body = self.s3.get_object(Bucket=member.bucket, Key=member.key)['Body']
+                if self.codec != 'none':
+                    self.body = CompressedReader(self.body, self.codec, self.level)
+                member.offset = self.position
+            except ClientError as ce:
+                print(f'Skipping {member.key} in pack: {ce}')
+
+    def read(self, size=-1):
+        if self.body is None and self.index == -1:
+            self.next_body()
+        while self.body is not None:
+            data = self.body.read(size) if size >= 0 else self.body.read()
+            if data:
+                self.position += len(data)
+                return data
+            self.next_body()
+        return b''
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+class ArchivePacker:
+    '''
+    input:
+        archive: called as archive(user_id, members) with the members of a
+                 pack that is due
+        window: seconds the oldest pending member of a user may wait
+        max_bytes: a user's pack is archived at once when it reaches this size
+        max_members: or this many members
+        concurrency: packs that are due by age archived at once
+    '''
+    def __init__(self, archive, window=60, max_bytes=256 * MB, max_members=1000, concurrency=2):
+        self.archive = archive
+        self.window = window
+        self.max_bytes = max_bytes
+        self.max_members = max_members
+        self.concurrency = max(1, concurrency)
+        self.lock = threading.Lock()
+        #user_id: (time the oldest member arrived, {job_id: Member})
+        self.pending = {}
+        self.thread = None
+        self.packs = 0
+        self.members = 0
+
+    def add(self, user_id, member):
+        '''
+        Queue a result for the user's next pack; a redelivered job replaces
+        its earlier entry, keeping the newest receipt handle
+        '''
+        with self.lock:
+            since, members = self.pending.setdefault(user_id, (time.time(), {}))
+            members[member.job_id] = member
+            full = (sum(m.size for m in members.values()) >= self.max_bytes
+                    or len(members) >= self.max_members)
+
+            #the window timer starts with the first result, not at import
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flush_by_age, daemon=True)
+                self.thread.start()
+
+        if full:
+            self.flush(user_id)
+
+    def _flush_by_age(self):
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        while True:
+            time.sleep(max(1, self.window / 4))
+            with self.lock:
+                now = time.time()
+                due = [user_id for user_id, (since, _) in self.pending.items() if now - since >= self.window]
+            #finish this round before looking again, so due packs do not pile up
+            list(executor.map(self.flush, due))
+
+    def flush(self, user_id):
+        with self.lock:
+            entry = self.pending.pop(user_id, None)
+        if not entry:
+            return
+
+        members = list(entry[1].values())
+        try:
+            self.archive(user_id, members)
+            with self.lock:
+                self.packs += 1
+                self.members += len(members)
+        except Exception as e:
+            #the members' messages are not acknowledged, so SQS delivers them again
+            print(f'Fail to archive pack of {len(members)} results for {user_id}: {e}')
+
+    def flush_all(self):
+        '''
+        Archive every pending pack now, e.g. on shutdown
+        '''
+        with self.lock:
+            users = list(self.pending)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(self.flush, users))
+
+    def stats(self):
+        with self.lock:
+            pending = sum(len(members) for _, members in self.pending.values())
+        return {'pending': pending, 'packs': self.packs, 'members': self.members}
+
+### EOF
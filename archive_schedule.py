@@ -0,0 +1,167 @@
+# archive_schedule.py
+#
+# Local stand-in for the state machine that delays archiving: results are
+# written to a SQLite file with the time they become due, and a background
+# thread fires whatever is due in batches. An entry stays in the file until
+# its result is archived; a fired entry that is not confirmed in time fires
+# again, so nothing is lost across crashes or restarts
+##
+
+import json
+import sqlite3
+import threading
+import time
+
+'''
+reference:
+    1. sqlite3: https://docs.python.org/3/library/sqlite3.html
+    2. write-ahead log: https://www.sqlite.org/wal.html
+    3. state machine wait state: https://docs.aws.amazon.com/step-functions/latest/dg/amazon-states-language-wait-state.html
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS schedule (
+    job_id TEXT PRIMARY KEY,
+    due REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS schedule_due ON schedule (due);
+'''
+
+class ArchiveScheduler:
+    '''
+    input:
+        path: SQLite file holding the schedule
+        fire: called with a list of (job_id, payload) that are due; each must
+              later be confirmed with done(), or it fires again after lease
+        lease: seconds a fired entry waits for done() before firing again
+        batch: most entries fired at once
+        max_attempts: fires after which an entry is dropped
+        max_sleep: longest idle wait between checks
+    '''
+    def __init__(self, path, fire, lease=600, batch=500, max_attempts=5, max_sleep=5):
+        self.path = path
+        self.fire = fire
+        self.lease = lease
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.max_sleep = max_sleep
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.db = None
+        self.thread = None
+        #earliest due time the thread is sleeping towards
+        self.next_due = None
+        self.fired = 0
+        self.dropped = 0
+
+    def connect(self):
+        #callers hold the lock
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            #entries are acknowledged upstream once written, so every commit is synced
+            self.db.execute('PRAGMA synchronous=FULL')
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def start(self):
+        '''
+        Start firing; entries left from an earlier run fire as they come due
+        '''
+        with self.lock:
+            self.connect()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def schedule(self, job_id, payload, due):
+        self.schedule_many([(job_id, payload, due)])
+
+    def schedule_many(self, entries):
+        '''
+        Durably add (job_id, payload, due) entries in one transaction; a job
+        already scheduled keeps its first due time
+        '''
+        rows = [(job_id, due, json.dumps(payload)) for job_id, payload, due in entries]
+        if not rows:
+            return
+        with self.lock:
+            db = self.connect()
+            with db:
+                db.execute('BEGIN')
+                db.executemany('INSERT OR IGNORE INTO schedule (job_id, due, payload) VALUES (?, ?, ?)', rows)
+            earlier = self.next_due is None or min(row[1] for row in rows) < self.next_due
+        if self.thread is None:
+            self.start()
+        elif earlier:
+            self.wake.set()
+
+    def done(self, job_ids):
+        '''
+        Confirm fired entries, removing them for good
+        '''
+        with self.lock:
+            db = self.connect()
+            with db:
+                db.execute('BEGIN')
+                db.executemany('DELETE FROM schedule WHERE job_id = ?', [(job_id,) for job_id in job_ids])
+
+    def take_due(self, now):
+        '''
+        Lease up to batch due entries, oldest first
+        output:
+            [(job_id, payload)]
+        '''
+        with self.lock:
+            db = self.connect()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                rows = db.execute('SELECT job_id, attempts, payload FROM schedule WHERE due <= ? '
+                                  'ORDER BY due LIMIT ?', (now, self.batch)).fetchall()
+                given_up = [(job_id,) for job_id, attempts, _ in rows if attempts >= self.max_attempts]
+                if given_up:
+                    db.executemany('DELETE FROM schedule WHERE job_id = ?', given_up)
+                db.executemany('UPDATE schedule SET due = ?, attempts = attempts + 1 WHERE job_id = ?',
+                               [(now + self.lease, job_id) for job_id, attempts, _ in rows
+                                if attempts < self.max_attempts])
+
+        if given_up:
+            print(f'Dropping {len(given_up)} scheduled archives after {self.max_attempts} attempts, '
+                  f'e.g. {given_up[0][0]}')
+            self.dropped += len(given_up)
+        return [(job_id, json.loads(payload)) for job_id, attempts, payload in rows
+                if attempts < self.max_attempts]
+
+    def _run(self):
+        while True:
+            try:
+                due = self.take_due(time.time())
+                if due:
+                    self.fired += len(due)
+                    self.fire(due)
+                    #a full batch means more may be due already
+                    if len(due) == self.batch:
+                        continue
+
+            except Exception as e:
+                print(f'Unexpected error in archive schedule: {e}')
+
+            with self.lock:
+                row = self.connect().execute('SELECT MIN(due) FROM schedule').fetchone()
+                self.next_due = row[0]
+            wait = self.max_sleep if self.next_due is None else min(self.max_sleep, self.next_due - time.time())
+            if wait > 0:
+                self.wake.wait(wait)
+            self.wake.clear()
+
+    def stats(self):
+        with self.lock:
+            db = self.connect()
+            pending, due, next_due = db.execute('SELECT COUNT(*), SUM(due <= ?), MIN(due) FROM schedule',
+                                                (time.time(),)).fetchone()
+        return {'pending': pending, 'due': due or 0, 'fired': self.fired, 'dropped': self.dropped,
+                'next_due': next_due}
+
+### EOF
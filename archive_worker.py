@@ -0,0 +1,222 @@
+# archive_worker.py
+#
+# Long-running consumer of the job result queue for archive_app.py: polls
+# SQS continuously and hands each message to a bounded pool of threads.
+# A message is acknowledged when its handler is done with it, left for a
+# later owner (e.g. the archive packer) when the handler says so, and made
+# visible again after a growing delay when the handler fails
+##
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+'''
+reference:
+    1. receive message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
+    2. change message visibility: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+    3. dead-letter queues: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-dead-letter-queues.html
+'''
+
+SQS_MAX_BATCH = 10
+#longest visibility timeout SQS accepts
+MAX_VISIBILITY = 12 * 60 * 60
+
+class ArchiveWorker:
+    '''
+    input:
+        sqs: boto3 SQS client
+        queue_url: queue to consume
+        handle: called with each message; returns True when the message can
+                be acknowledged now, False when someone else acknowledges it
+                later; raising makes it retried
+        acker: BatchAcker of the queue
+        workers: messages handled at once
+        wait_time: long poll seconds per receive
+        max_rate: messages started per second, 0 for no limit
+        retry_base: seconds a failed message stays hidden after its first
+                    failure; doubled for each further receive
+        retry_max: longest delay before a retry
+        max_receives: receives after which a failing message is left alone
+                      for the queue's redrive policy to move
+        rate_window: seconds of history behind the reported rate
+    '''
+    def __init__(self, sqs, queue_url, handle, acker, workers=4, wait_time=20, max_rate=0,
+                 retry_base=30, retry_max=900, max_receives=5, rate_window=60):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.handle = handle
+        self.acker = acker
+        self.workers = max(1, workers)
+        self.wait_time = wait_time
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.retry_base = retry_base
+        self.retry_max = min(retry_max, MAX_VISIBILITY)
+        self.max_receives = max_receives
+        self.rate_window = rate_window
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.executor = None
+        self.next_start = 0
+        self.done_at = deque()
+        self.in_flight = 0
+        self.counts = {'received': 0, 'acked': 0, 'deferred': 0, 'retried': 0,
+                       'given_up': 0, 'empty_receives': 0}
+
+    def start(self):
+        '''
+        Start polling in the background; later calls only cut short an idle wait
+        output:
+            started: True when this call started the worker
+        '''
+        with self.lock:
+            started = self.thread is None or not self.thread.is_alive()
+            if started:
+                self.stopping.clear()
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wake.set()
+        return started
+
+    def stop(self, timeout=None):
+        '''
+        Stop receiving and wait for the messages being handled
+        '''
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def run(self):
+        print(f'Archive worker polling with {self.workers} workers')
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        while not self.stopping.is_set():
+            #block until at least one worker is free, then grab the rest without waiting
+            self.slots.acquire()
+            free = 1
+            while free < min(self.workers, SQS_MAX_BATCH) and self.slots.acquire(blocking=False):
+                free += 1
+
+            messages = self.receive(free)
+
+            #give back the slots nothing arrived for
+            for _ in range(free - len(messages)):
+                self.slots.release()
+
+            for message in messages:
+                self.pace()
+                with self.lock:
+                    self.in_flight += 1
+                self.executor.submit(self.run_slot, message)
+
+    def receive(self, count):
+        try:
+            messages = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                                MaxNumberOfMessages=count,
+                                                WaitTimeSeconds=self.wait_time,
+                                                AttributeNames=['ApproximateReceiveCount']).get('Messages', [])
+
+        except ClientError as ce:
+            print(f'Fail to receive the message {ce}')
+            messages = []
+
+        except Exception as e:
+            print(f'Unexpected error when receiving message {e}')
+            messages = []
+
+        with self.lock:
+            self.counts['received'] += len(messages)
+            if not messages:
+                self.counts['empty_receives'] += 1
+
+        if not messages and not self.stopping.is_set():
+            #a trigger ends the pause early
+            self.wake.wait(1)
+            self.wake.clear()
+        return messages
+
+    def pace(self):
+        #start at most max_rate messages a second
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_start > now:
+            time.sleep(self.next_start - now)
+        self.next_start = max(now, self.next_start) + self.interval
+
+    def run_slot(self, message):
+        try:
+            self.process(message)
+
+        except Exception as e:
+            print(f'Unexpected error in archive worker: {e}')
+
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.done_at.append(time.monotonic())
+            self.slots.release()
+
+    def process(self, message):
+        try:
+            done = self.handle(message)
+
+        except Exception as e:
+            self.retry(message, e)
+            return
+
+        if done:
+            self.acker.ack(message['ReceiptHandle'])
+            outcome = 'acked'
+        else:
+            outcome = 'deferred'
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def retry(self, message, error):
+        receives = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+        if self.max_receives and receives >= self.max_receives:
+            #left as it is; the redrive policy moves it to the dead-letter queue
+            print(f'Giving up on message {message.get("MessageId")} after {receives} receives: {error}')
+            with self.lock:
+                self.counts['given_up'] += 1
+            return
+
+        delay = min(self.retry_base * 2 ** (receives - 1), self.retry_max)
+        print(f'Retrying message {message.get("MessageId")} in {delay}s: {error}')
+        try:
+            self.sqs.change_message_visibility(QueueUrl=self.queue_url,
+                                               ReceiptHandle=message['ReceiptHandle'],
+                                               VisibilityTimeout=int(delay))
+        except ClientError as ce:
+            print(f'Fail to delay message retry: {ce}')
+
+        with self.lock:
+            self.counts['retried'] += 1
+
+    def stats(self):
+        '''
+        output:
+            counts, in flight and messages finished per second over rate_window
+        '''
+        with self.lock:
+            now = time.monotonic()
+            while self.done_at and now - self.done_at[0] > self.rate_window:
+                self.done_at.popleft()
+            rate = len(self.done_at) / self.rate_window
+            running = self.thread is not None and self.thread.is_alive()
+            return dict(self.counts, in_flight=self.in_flight, workers=self.workers,
+                        running=running, rate_per_s=round(rate, 3))
+
+### EOF
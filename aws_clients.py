@@ -0,0 +1,185 @@
+# aws_clients.py
+#
+# One lazily-initialised factory for the boto3 clients and resources used by
+# the web app, the annotator, the utility apps and the restore lambda.
+# Clients are thread-safe and shared per process; resources are not, so
+# each thread gets its own. Nothing is created until first use, and the
+# time spent creating each one is logged and kept for startup_report().
+# boto3 itself is imported with the first client, so importing this module
+# costs nothing on a cold start
+##
+
+import json
+import os
+import threading
+import time
+
+'''
+reference:
+    1. botocore config: https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+    2. retries: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/retries.html
+    3. multithreading: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
+'''
+
+DEFAULTS = {'region_name': None,
+            'max_pool_connections': 25,
+            'retry_mode': 'adaptive',
+            'max_attempts': 5,
+            'connect_timeout': 5,
+            'read_timeout': 60}
+
+#config / environment keys read by from_mapping, with their types
+MAPPING_KEYS = {'AWS_REGION_NAME': ('region_name', str),
+                'AWS_MAX_POOL_CONNECTIONS': ('max_pool_connections', int),
+                'AWS_RETRY_MODE': ('retry_mode', str),
+                'AWS_MAX_ATTEMPTS': ('max_attempts', int),
+                'AWS_CONNECT_TIMEOUT': ('connect_timeout', float),
+                'AWS_READ_TIMEOUT': ('read_timeout', float)}
+
+settings = dict(DEFAULTS)
+lock = threading.RLock()
+local = threading.local()
+clients = {}
+owner_pid = os.getpid()
+session = None
+#(service, kind, seconds) for every client or resource created
+timings = []
+
+def configure(**kwargs):
+    '''
+    Set region, pool size, retries and timeouts; call once at startup,
+    before the first client is used. None values keep the current setting
+    '''
+    with lock:
+        settings.update({k: v for k, v in kwargs.items() if v is not None})
+        clients.clear()
+    local.__dict__.clear()
+
+def from_mapping(mapping):
+    '''
+    configure() arguments from a Flask config or os.environ
+    '''
+    return {name: cast(mapping[key]) for key, (name, cast) in MAPPING_KEYS.items()
+            if mapping.get(key) not in (None, '')}
+
+def make_config(**overrides):
+    from botocore.config import Config
+    return Config(max_pool_connections=settings['max_pool_connections'],
+                  retries={'mode': settings['retry_mode'], 'max_attempts': settings['max_attempts']},
+                  connect_timeout=settings['connect_timeout'],
+                  read_timeout=settings['read_timeout'],
+                  **overrides)
+
+def timed(service, kind, create):
+    start = time.perf_counter()
+    created = create()
+    seconds = time.perf_counter() - start
+    timings.append((service, kind, seconds))
+    print(json.dumps({'event': 'aws_client', 'service': service, 'kind': kind,
+                      'seconds': round(seconds, 6)}))
+    return created
+
+def check_fork():
+    #clients hold sockets and locks that must not be shared with a forked child
+    global owner_pid, session
+    if os.getpid() != owner_pid:
+        owner_pid, session = os.getpid(), None
+        clients.clear()
+
+def shared_session():
+    #creating clients from one session in parallel is not safe; callers hold the lock
+    global session
+    check_fork()
+    if session is None:
+        import boto3.session
+        session = boto3.session.Session()
+    return session
+
+def client(service, **overrides):
+    '''
+    Shared client of a service, e.g. client('s3', signature_version='s3v4')
+    input:
+        overrides: extra botocore Config options
+    '''
+    key = (service, tuple(sorted(overrides.items())))
+    found = clients.get(key)
+    if found is not None and os.getpid() == owner_pid:
+        return found
+
+    with lock:
+        if key not in clients or os.getpid() != owner_pid:
+            source = shared_session()
+            clients[key] = timed(service, 'client', lambda: source.client(
+                service, region_name=settings['region_name'], config=make_config(**overrides)))
+        return clients[key]
+
+def resource(service, **overrides):
+    '''
+    This thread's resource of a service; resources are not thread-safe, but
+    they are built from the shared session so its parsed models are reused
+    '''
+    key = (service, tuple(sorted(overrides.items())))
+    if getattr(local, 'pid', None) != os.getpid():
+        local.pid, local.resources, local.tables = os.getpid(), {}, {}
+
+    found = local.resources.get(key)
+    if found is None:
+        with lock:
+            source = shared_session()
+            found = local.resources[key] = timed(service, 'resource', lambda: source.resource(
+                service, region_name=settings['region_name'], config=make_config(**overrides)))
+    return found
+
+def table(name):
+    return LazyTable(name)
+
+def startup_report():
+    '''
+    output:
+        {'created', 'seconds', 'services': {service: seconds}}
+    '''
+    services = {}
+    for service, kind, seconds in list(timings):
+        services[service] = round(services.get(service, 0) + seconds, 6)
+    return {'created': len(timings), 'seconds': round(sum(services.values()), 6), 'services': services}
+
+
+class LazyClient:
+    '''
+    Stands in for a module-level client; the client is created on first use
+    '''
+    def __init__(self, service, **overrides):
+        self._service = service
+        self._overrides = overrides
+
+    def __getattr__(self, name):
+        return getattr(client(self._service, **self._overrides), name)
+
+
+class LazyResource:
+    def __init__(self, service, **overrides):
+        self._service = service
+        self._overrides = overrides
+
+    def __getattr__(self, name):
+        return getattr(resource(self._service, **self._overrides), name)
+
+    def Table(self, name):
+        return LazyTable(name)
+
+
+class LazyTable:
+    '''
+    A DynamoDB table bound to the calling thread's resource
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        dynamo = resource('dynamodb')
+        found = local.tables.get(self.name)
+        if found is None:
+            found = local.tables[self.name] = dynamo.Table(self.name)
+        return getattr(found, attr)
+
+### EOF
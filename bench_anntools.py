@@ -0,0 +1,95 @@
+# bench_anntools.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Compares per-job latency of the two run_anntools engines: a fresh
+# `python run.py` per job (popen) against the pre-forked warm pool (warm)
+#
+# usage: python bench_anntools.py <input.vcf> [--jobs 20] [--script run.py]
+#            [--preload driver] [--path anntools_dir] [--max-jobs 100]
+##
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from supervisor import AnnSupervisor
+from warm_pool import WarmPool
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def report(name, latencies):
+    print(f'{name:>6}: jobs={len(latencies)} '
+          f'mean={statistics.mean(latencies):.3f}s '
+          f'p50={percentile(latencies, 50):.3f}s '
+          f'p95={percentile(latencies, 95):.3f}s '
+          f'max={max(latencies):.3f}s')
+
+def copy_input(vcf, workdir):
+    #every job gets its own copy, as handle_message gives every job its own folder
+    folder = os.path.join(workdir, str(uuid.uuid4()))
+    os.makedirs(folder)
+    filename = os.path.join(folder, os.path.basename(vcf))
+    shutil.copy(vcf, filename)
+    return filename
+
+def bench_popen(args, workdir):
+    supervisor = AnnSupervisor(max_children=1)
+    latencies = []
+    for i in range(args.jobs):
+        filename = copy_input(args.vcf, workdir)
+        start = time.time()
+        supervisor.submit([sys.executable, args.script, filename, f'popen-{i}'], f'popen-{i}').wait()
+        latencies.append(time.time() - start)
+    return latencies
+
+def bench_warm(args, workdir):
+    pool = WarmPool(workers=1, max_jobs=args.max_jobs, script=args.script,
+                    preload=args.preload, paths=args.path)
+
+    #first job only warms the pool up and is not counted
+    pool.submit(copy_input(args.vcf, workdir), 'warm-up').wait()
+
+    latencies = []
+    for i in range(args.jobs):
+        filename = copy_input(args.vcf, workdir)
+        start = time.time()
+        pool.submit(filename, f'warm-{i}').wait()
+        latencies.append(time.time() - start)
+
+    pool.close()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-job latency of popen vs warm anntools engines')
+    parser.add_argument('vcf', help='input VCF used for every job')
+    parser.add_argument('--jobs', type=int, default=20)
+    parser.add_argument('--script', default='run.py', help='AnnTools entry script')
+    parser.add_argument('--preload', action='append', default=[], help='module the warm workers import up front')
+    parser.add_argument('--path', action='append', default=[], help='directory added to sys.path for preloading')
+    parser.add_argument('--max-jobs', type=int, default=100, help='jobs per warm worker before recycling')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_anntools_')
+    try:
+        popen = bench_popen(args, workdir)
+        warm = bench_warm(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report('popen', popen)
+    report('warm', warm)
+    print(f'warm pool saves {statistics.mean(popen) - statistics.mean(warm):.3f}s per job on average')
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,199 @@
+# bench_lambda.py
+#
+# Local cold/warm-start benchmark of the restore lambda (lambda.py). Each
+# mode runs in a fresh interpreter, as a new execution environment would:
+# it imports the function, handles one restore message (cold), then
+# handles --invocations more one at a time (warm). AWS is a moto server on
+# localhost, reached through AWS_ENDPOINT_URL; no network is used.
+#
+#   lazy:  lambda.py as shipped
+#   eager: imports boto3 and creates the DynamoDB, Glacier, S3 and SQS
+#          clients before importing lambda.py, as it did at import before
+#
+# usage: python bench_lambda.py [--invocations 5] [--modes lazy eager] [--json]
+#
+# needs boto3 and moto[server]
+##
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+REGION = 'us-east-1'
+TABLE = 'bench_annotations'
+BUCKET = 'bench-results'
+VAULT = 'bench-vault'
+QUEUE = 'bench-restore'
+#marks the result line among the function's own output
+RESULT_MARK = 'BENCH_RESULT '
+
+def rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def run_one(mode, messages_file):
+    '''
+    One execution environment; prints one JSON line
+    '''
+    start = time.perf_counter()
+    sys.path.insert(0, REPO)
+
+    if mode == 'eager':
+        import boto3
+        from boto3.dynamodb.conditions import Attr
+        boto3.resource('dynamodb', region_name=REGION).Table(TABLE)
+        for service in ('glacier', 's3', 'sqs'):
+            boto3.client(service, region_name=REGION)
+
+    import importlib
+    function = importlib.import_module('lambda')
+    imported = time.perf_counter()
+    import_rss = rss_mb()
+
+    with open(messages_file) as f:
+        messages = json.load(f)
+
+    #the first message was queued before this interpreter started
+    function.lambda_handler({}, None)
+    first = time.perf_counter()
+
+    warm = []
+    for body in messages[1:]:
+        function.sqs_client.send_message(QueueUrl=function.RESTORE_SQS, MessageBody=body)
+        invoked = time.perf_counter()
+        function.lambda_handler({}, None)
+        warm.append(time.perf_counter() - invoked)
+
+    warm.sort()
+    print(RESULT_MARK + json.dumps({'mode': mode,
+                                    'import_s': round(imported - start, 4),
+                                    'first_invocation_s': round(first - imported, 4),
+                                    'import_to_first_message_s': round(first - start, 4),
+                                    'warm_p50_s': round(warm[len(warm) // 2], 4) if warm else None,
+                                    'warm_max_s': round(warm[-1], 4) if warm else None,
+                                    'import_rss_mb': import_rss,
+                                    'peak_rss_mb': rss_mb()}))
+
+def prepare(endpoint, modes, invocations, workdir):
+    '''
+    Table, bucket, vault and one completed Glacier retrieval per message
+    output:
+        queue_url, {mode: path of that mode's message bodies}
+    '''
+    import boto3
+
+    kwargs = {'region_name': REGION, 'endpoint_url': endpoint}
+    dynamo = boto3.resource('dynamodb', **kwargs)
+    s3 = boto3.client('s3', **kwargs)
+    glacier = boto3.client('glacier', **kwargs)
+    sqs = boto3.client('sqs', **kwargs)
+
+    dynamo.create_table(TableName=TABLE,
+                        KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+                        AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'},
+                                              {'AttributeName': 'user_id', 'AttributeType': 'S'}],
+                        GlobalSecondaryIndexes=[{'IndexName': 'user_id_index',
+                                                 'KeySchema': [{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
+                                                 'Projection': {'ProjectionType': 'ALL'}}],
+                        BillingMode='PAY_PER_REQUEST')
+    table = dynamo.Table(TABLE)
+    s3.create_bucket(Bucket=BUCKET)
+    glacier.create_vault(vaultName=VAULT)
+    #the function only reads the vault name from the end of the ARN
+    vault_arn = f'arn:aws:glacier:{REGION}:123456789012:vaults/{VAULT}'
+    queue_url = sqs.create_queue(QueueName=QUEUE)['QueueUrl']
+
+    files, pending = {}, []
+    for mode in modes:
+        bodies = []
+        for i in range(invocations + 1):
+            user_id, job_id = f'{mode}-user-{i}', f'{mode}-job-{i}'
+            archive_id = glacier.upload_archive(vaultName=VAULT, body=os.urandom(64 * 1024))['archiveId']
+            retrieval = glacier.initiate_job(vaultName=VAULT, jobParameters={
+                'Type': 'archive-retrieval', 'ArchiveId': archive_id, 'Description': user_id})['jobId']
+            table.put_item(Item={'job_id': job_id, 'user_id': user_id, 's3_results_bucket': BUCKET,
+                                 's3_key_result_file': f'bench/{user_id}/{job_id}~input.annot.vcf',
+                                 'results_file_archive_id': archive_id})
+            notification = {'ArchiveId': archive_id, 'VaultARN': vault_arn, 'JobId': retrieval,
+                            'JobDescription': user_id}
+            bodies.append(json.dumps({'Type': 'Notification', 'Message': json.dumps(notification)}))
+            pending.append(retrieval)
+
+        files[mode] = os.path.join(workdir, f'{mode}.json')
+        with open(files[mode], 'w') as f:
+            json.dump(bodies, f)
+
+    #retrievals complete a few seconds after they start
+    for retrieval in pending:
+        while not glacier.describe_job(vaultName=VAULT, jobId=retrieval)['Completed']:
+            time.sleep(0.5)
+
+    return sqs, queue_url, files
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold/warm-start benchmark of the restore lambda')
+    parser.add_argument('--invocations', type=int, default=5, help='warm invocations after the cold one')
+    parser.add_argument('--modes', nargs='+', default=['lazy', 'eager'], choices=['lazy', 'eager'])
+    parser.add_argument('--json', action='store_true', help='print raw JSON lines')
+    parser.add_argument('--one', help=argparse.SUPPRESS)
+    parser.add_argument('--messages', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        run_one(args.one, args.messages)
+        return
+
+    import logging
+    import tempfile
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    for key, value in {'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+                       'AWS_DEFAULT_REGION': REGION}.items():
+        os.environ[key] = value
+
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    endpoint = 'http://127.0.0.1:%d' % server.get_host_and_port()[1]
+
+    results = []
+    try:
+        workdir = tempfile.mkdtemp(prefix='bench_lambda_')
+        sqs, queue_url, files = prepare(endpoint, args.modes, args.invocations, workdir)
+        env = dict(os.environ, AWS_ENDPOINT_URL=endpoint, ANN_TABLE=TABLE, RESTORE_SQS=queue_url)
+
+        for mode in args.modes:
+            with open(files[mode]) as f:
+                sqs.send_message(QueueUrl=queue_url, MessageBody=json.load(f)[0])
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--one', mode,
+                                  '--messages', files[mode]],
+                                 capture_output=True, text=True, env=env, cwd=workdir)
+            if out.returncode:
+                print(out.stderr[-2000:], file=sys.stderr)
+                sys.exit(f'run failed: mode={mode}')
+            line = [l for l in out.stdout.splitlines() if l.startswith(RESULT_MARK)][-1]
+            results.append(json.loads(line[len(RESULT_MARK):]))
+    finally:
+        server.stop()
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    fmt = lambda v: '-' if v is None else f'{v:.3f}'
+    print(f'{"mode":>6} {"import s":>9} {"1st inv s":>10} {"to 1st s":>9} {"warm p50":>9} '
+          f'{"warm max":>9} {"import MB":>10} {"peak MB":>8}')
+    for r in results:
+        print(f'{r["mode"]:>6} {fmt(r["import_s"]):>9} {fmt(r["first_invocation_s"]):>10} '
+              f'{fmt(r["import_to_first_message_s"]):>9} {fmt(r["warm_p50_s"]):>9} '
+              f'{fmt(r["warm_max_s"]):>9} {r["import_rss_mb"]:>10} {r["peak_rss_mb"]:>8}')
+
+if __name__ == '__main__':
+    main()
+
+### EOF
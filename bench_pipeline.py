@@ -0,0 +1,278 @@
+# bench_pipeline.py
+#
+# Offline end-to-end benchmark of the annotation pipeline:
+# view.create_annotation_job_request -> outbox -> SNS/SQS -> annotator -> stub run.py
+# against in-process moto stand-ins for S3, SQS, SNS and DynamoDB. No network
+# is used. Every (input size, concurrency) pair runs in a fresh interpreter so
+# module state and peak memory do not leak between runs.
+#
+# usage: python bench_pipeline.py [--jobs 50] [--input-kb 16 1024]
+#            [--concurrency 1 4 8] [--work-ms 50] [--json]
+#
+# needs boto3, moto, flask, flask_wtf and stripe (the web app's requirements)
+#
+# peak child RSS is the high-water mark of the run.py children; on Linux it
+# includes the pages inherited at fork, so it is at least the parent's RSS
+##
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+REGION = 'us-east-1'
+CNET_ID = 'bench'
+INPUTS_BUCKET = 'bench-inputs'
+RESULTS_BUCKET = 'bench-results'
+TABLE = 'bench_annotations'
+#marks the result line among the annotator's own output
+RESULT_MARK = 'BENCH_RESULT '
+
+#annotates nothing: copies the input, writes a log and optionally burns time
+STUB_RUN = '''import sys, time
+filename = sys.argv[1]
+deadline = time.time() + {work_ms} / 1000
+while time.time() < deadline:
+    pass
+with open(filename) as f, open(filename.replace('.vcf', '.annot.vcf'), 'w') as out:
+    lines = 0
+    for line in f:
+        out.write(line)
+        lines += 1
+with open(filename + '.count.log', 'w') as log:
+    log.write(f'{{lines}} lines\\n')
+'''
+
+ANN_CONFIG = '''[DEFAULT]
+CnetId = {cnet_id}
+
+[ann]
+DATA_PATH = {data}/
+Concurrent = true
+Workers = {concurrency}
+MaxChildren = {concurrency}
+MaxLoad = 1000
+MinFreeMemory = 0
+MinFreeDisk = 0
+InputCacheBytes = 0
+
+[aws]
+AwsRegionName = {region}
+
+[db]
+ANN_TABLE = {table}
+
+[sqs]
+QUEUE_URL = {queue_url}
+MaxMessages = 10
+WaitTime = 1
+AckMaxAge = 0.2
+
+[s3]
+ResultsBucket = {results_bucket}
+
+[sns]
+ResultsTopic = {results_topic}
+'''
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def make_vcf(path, kb):
+    header = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+    record = '1\t{pos}\t.\tA\tG\t50\tPASS\tDP=30\n'
+    with open(path, 'w') as f:
+        f.write(header)
+        size, pos = len(header), 1
+        while size < kb * 1024:
+            line = record.format(pos=pos)
+            f.write(line)
+            size += len(line)
+            pos += 1
+
+def install_web_stand_ins(templates, request_topic):
+    '''
+    view.py imports its Flask app, decorators and auth from the web
+    package, which is not part of this tree; give it minimal local ones
+    '''
+    import types
+    from flask import Flask
+
+    web = Flask('bench_web', template_folder=templates)
+    web.secret_key = 'bench'
+    web.config.update(AWS_REGION_NAME=REGION,
+                      AWS_DYNAMODB_ANNOTATIONS_TABLE=TABLE,
+                      AWS_SNS_JOB_REQUEST_TOPIC=request_topic,
+                      AWS_S3_INPUTS_BUCKET=INPUTS_BUCKET,
+                      AWS_S3_RESULTS_BUCKET=RESULTS_BUCKET,
+                      AWS_S3_KEY_PREFIX=f'{CNET_ID}/',
+                      AWS_SIGNED_REQUEST_EXPIRATION=60,
+                      FREE_USER_DATA_RETENTION=180,
+                      SECRET_KEY='bench')
+
+    app_module = types.ModuleType('app')
+    app_module.app, app_module.db = web, None
+    decorators = types.ModuleType('decorators')
+    decorators.authenticated = lambda fn: fn
+    decorators.is_premium = lambda fn: fn
+    auth = types.ModuleType('auth')
+    auth.update_profile = lambda identity_id, role: None
+    auth.get_profile = lambda identity_id: types.SimpleNamespace(role='free_user')
+    sys.modules.update({'app': app_module, 'decorators': decorators, 'auth': auth})
+    return web
+
+def run_one(jobs, input_kb, concurrency, work_ms):
+    '''
+    One benchmark run; runs in its own interpreter, prints one JSON line
+    '''
+    import boto3
+    from moto import mock_aws
+
+    for key, value in {'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+                       'AWS_DEFAULT_REGION': REGION}.items():
+        os.environ[key] = value
+
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=REGION)
+        sns = boto3.client('sns', region_name=REGION)
+        sqs = boto3.client('sqs', region_name=REGION)
+        dynamo = boto3.client('dynamodb', region_name=REGION)
+
+        for bucket in (INPUTS_BUCKET, RESULTS_BUCKET):
+            s3.create_bucket(Bucket=bucket)
+        dynamo.create_table(TableName=TABLE,
+                            KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'submit_time', 'AttributeType': 'N'}],
+                            #submit_time orders a user's annotations list
+                            GlobalSecondaryIndexes=[{'IndexName': 'user_id_index',
+                                                     'KeySchema': [{'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                                                                   {'AttributeName': 'submit_time', 'KeyType': 'RANGE'}],
+                                                     'Projection': {'ProjectionType': 'ALL'}}],
+                            BillingMode='PAY_PER_REQUEST')
+        request_topic = sns.create_topic(Name='bench_job_requests')['TopicArn']
+        results_topic = sns.create_topic(Name='bench_job_results')['TopicArn']
+        queue_url = sqs.create_queue(QueueName='bench_job_requests')['QueueUrl']
+        queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+        sns.subscribe(TopicArn=request_topic, Protocol='sqs', Endpoint=queue_arn)
+
+        templates = os.path.join(workdir, 'templates')
+        os.makedirs(templates)
+        with open(os.path.join(templates, 'annotate_confirm.html'), 'w') as f:
+            f.write('{{ job_id }}')
+        with open('run.py', 'w') as f:
+            f.write(STUB_RUN.format(work_ms=work_ms))
+        with open('annotator_config.ini', 'w') as f:
+            f.write(ANN_CONFIG.format(cnet_id=CNET_ID, data=os.path.join(workdir, 'data'),
+                                      concurrency=concurrency, region=REGION, table=TABLE,
+                                      queue_url=queue_url, results_bucket=RESULTS_BUCKET,
+                                      results_topic=results_topic))
+
+        vcf = os.path.join(workdir, 'input.vcf')
+        make_vcf(vcf, input_kb)
+
+        web = install_web_stand_ins(templates, request_topic)
+        from flask import session
+        import view
+        import annotator
+
+        #timestamp each job as the annotator marks it RUNNING
+        running_at = {}
+        set_running = annotator.set_running
+        def timed_set_running(job_id):
+            claimed = set_running(job_id)
+            running_at[job_id] = time.time()
+            return claimed
+        annotator.set_running = timed_set_running
+
+        annotator.start_metrics()
+        threading.Thread(target=annotator.run_worker_pool, args=(concurrency,), daemon=True).start()
+
+        submitted_at = {}
+        submit_seconds = []
+        user_id = str(uuid.uuid4())
+        start = time.time()
+        for _ in range(jobs):
+            job_id = str(uuid.uuid4())
+            key = f'{CNET_ID}/{user_id}/{job_id}~input.vcf'
+            s3.upload_file(vcf, INPUTS_BUCKET, key)
+            with web.test_request_context('/annotate/job', query_string={'bucket': INPUTS_BUCKET, 'key': key}):
+                session['primary_identity'] = user_id
+                submitted_at[job_id] = time.time()
+                view.create_annotation_job_request()
+                submit_seconds.append(time.time() - submitted_at[job_id])
+
+        while annotator.supervisor.summary()['finished'] < jobs:
+            time.sleep(0.05)
+        elapsed = time.time() - start
+
+    latencies = [running_at[j] - submitted_at[j] for j in submitted_at if j in running_at]
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(RESULT_MARK + json.dumps({'jobs': jobs, 'input_kb': input_kb, 'concurrency': concurrency,
+                      'jobs_per_sec': round(jobs / elapsed, 2),
+                      'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                      'p99': percentile(latencies, 99),
+                      'submit_p50': percentile(submit_seconds, 50),
+                      'submit_p99': percentile(submit_seconds, 99),
+                      'peak_rss_mb': round(self_rss / 1024, 1),
+                      'peak_child_rss_mb': round(child_rss / 1024, 1)}))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of the annotation pipeline')
+    parser.add_argument('--jobs', type=int, default=50)
+    parser.add_argument('--input-kb', type=int, nargs='+', default=[16, 1024])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--work-ms', type=int, default=50, help='time the stub run.py spends per job')
+    parser.add_argument('--json', action='store_true', help='print raw JSON lines')
+    parser.add_argument('--one', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        run_one(args.jobs, args.input_kb[0], args.concurrency[0], args.work_ms)
+        return
+
+    results = []
+    for input_kb in args.input_kb:
+        for concurrency in args.concurrency:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--one',
+                                  '--jobs', str(args.jobs), '--input-kb', str(input_kb),
+                                  '--concurrency', str(concurrency), '--work-ms', str(args.work_ms)],
+                                 capture_output=True, text=True)
+            if out.returncode:
+                print(out.stderr[-2000:], file=sys.stderr)
+                sys.exit(f'run failed: input_kb={input_kb} concurrency={concurrency}')
+            line = [l for l in out.stdout.splitlines() if l.startswith(RESULT_MARK)][-1]
+            results.append(json.loads(line[len(RESULT_MARK):]))
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    fmt = lambda v: '-' if v is None else f'{v:.3f}'
+    print(f'{"input_kb":>9} {"conc":>5} {"jobs/s":>8} {"p50 s":>8} {"p95 s":>8} {"p99 s":>8} {"sub p50":>8} {"sub p99":>8} {"rss MB":>8} {"child MB":>9}')
+    for r in results:
+        print(f'{r["input_kb"]:>9} {r["concurrency"]:>5} {r["jobs_per_sec"]:>8} {fmt(r["p50"]):>8} '
+              f'{fmt(r["p95"]):>8} {fmt(r["p99"]):>8} {fmt(r["submit_p50"]):>8} {fmt(r["submit_p99"]):>8} {r["peak_rss_mb"]:>8} {r["peak_child_rss_mb"]:>9}')
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,177 @@
+# glacier_upload.py
+#
+# Streams an archive into Glacier with a multipart upload: parts are read
+# from any file-like body (e.g. an S3 StreamingBody) one at a time, hashed
+# into the SHA-256 tree hash as they go and uploaded in parallel, so at most
+# a few parts are ever held in memory
+##
+
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+
+'''
+reference:
+    1. multipart upload: https://docs.aws.amazon.com/amazonglacier/latest/dev/uploading-archive-mpu.html
+    2. tree hash: https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+    3. upload multipart part: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_multipart_part.html
+'''
+
+MB = 1024 * 1024
+#part sizes Glacier accepts: 1 MB times a power of two, up to 4 GB
+MIN_PART_SIZE = MB
+MAX_PART_SIZE = 4096 * MB
+#service errors plus the connection failures a long part upload commonly hits
+TRANSIENT_ERRORS = (ClientError, EndpointConnectionError, ReadTimeoutError, ConnectionClosedError)
+
+def tree_hash_leaves(data):
+    #SHA-256 of every 1 MB chunk
+    return [hashlib.sha256(data[i:i + MB]).digest() for i in range(0, len(data), MB)] \
+        or [hashlib.sha256(b'').digest()]
+
+def combine(hashes):
+    '''
+    Root of a tree hash: hash neighbours pairwise, level by level, carrying
+    an odd one up unchanged
+    '''
+    while len(hashes) > 1:
+        paired = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest() for i in range(0, len(hashes) - 1, 2)]
+        if len(hashes) % 2:
+            paired.append(hashes[-1])
+        hashes = paired
+    return hashes[0]
+
+
+class TreeHash:
+    '''
+    Incremental tree hash over 1 MB leaf digests fed in order; keeps one
+    digest per level, like a binary counter, instead of every leaf
+    '''
+    def __init__(self):
+        self.stack = []
+
+    def update(self, leaf):
+        node, size = leaf, 1
+        while self.stack and self.stack[-1][1] == size:
+            left, _ = self.stack.pop()
+            node, size = hashlib.sha256(left + node).digest(), size * 2
+        self.stack.append((node, size))
+
+    def hexdigest(self):
+        if not self.stack:
+            return hashlib.sha256(b'').hexdigest()
+        #the complete subtrees left on the stack join from the right
+        node = self.stack[-1][0]
+        for left, _ in reversed(self.stack[:-1]):
+            node = hashlib.sha256(left + node).digest()
+        return node.hex()
+
+
+def read_part(body, size):
+    #a streaming body may return less than asked before the end
+    chunks, read = [], 0
+    while read < size:
+        chunk = body.read(size - read)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        read += len(chunk)
+    return b''.join(chunks)
+
+
+class GlacierUploader:
+    '''
+    input:
+        glacier: boto3 Glacier client
+        vault: vault name
+        part_size: bytes per part, 1 MB times a power of two
+        concurrency: parts uploaded at once; memory holds about
+                     concurrency + 1 parts
+        max_retries: attempts per part
+    '''
+    def __init__(self, glacier, vault, part_size=8 * MB, concurrency=4, max_retries=3):
+        megabytes = part_size // MB
+        if part_size % MB or not MIN_PART_SIZE <= part_size <= MAX_PART_SIZE or megabytes & (megabytes - 1):
+            raise ValueError(f'part size must be 1 MB times a power of two up to 4 GB: {part_size}')
+        self.glacier = glacier
+        self.vault = vault
+        self.part_size = part_size
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+
+    def upload(self, body, description=None):
+        '''
+        output:
+            (archive_id, size, checksum); archive_id is None for an empty body
+        '''
+        part = read_part(body, self.part_size)
+        if not part:
+            return None, 0, None
+
+        kwargs = {'vaultName': self.vault, 'partSize': str(self.part_size)}
+        if description:
+            kwargs['archiveDescription'] = description
+        upload_id = self.glacier.initiate_multipart_upload(**kwargs)['uploadId']
+
+        tree, size, futures = TreeHash(), 0, []
+        #parts queued or uploading; one more is held while it is read and hashed
+        slots = threading.BoundedSemaphore(self.concurrency)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        try:
+            while part:
+                leaves = tree_hash_leaves(part)
+                for leaf in leaves:
+                    tree.update(leaf)
+
+                slots.acquire()
+                future = executor.submit(self.upload_part, upload_id, size, part, combine(leaves).hex())
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+
+                #stop early once a part has failed; one pass, so no part finishes unchecked
+                pending = []
+                for f in futures:
+                    if not f.done():
+                        pending.append(f)
+                    elif f.exception():
+                        raise f.exception()
+                futures = pending
+
+                size += len(part)
+                part = read_part(body, self.part_size)
+
+            for future in futures:
+                future.result()
+
+            checksum = tree.hexdigest()
+            response = self.glacier.complete_multipart_upload(vaultName=self.vault, uploadId=upload_id,
+                                                              archiveSize=str(size), checksum=checksum)
+
+        except Exception:
+            executor.shutdown(wait=True, cancel_futures=True)
+            try:
+                self.glacier.abort_multipart_upload(vaultName=self.vault, uploadId=upload_id)
+            except TRANSIENT_ERRORS as ce:
+                print(f'Fail to abort multipart upload {upload_id}: {ce}')
+            raise
+
+        executor.shutdown(wait=True)
+        return response['archiveId'], size, checksum
+
+    def upload_part(self, upload_id, start, data, checksum):
+        byte_range = f'bytes {start}-{start + len(data) - 1}/*'
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return self.glacier.upload_multipart_part(vaultName=self.vault, uploadId=upload_id,
+                                                          range=byte_range, checksum=checksum, body=data)
+            except TRANSIENT_ERRORS as ce:
+                if attempt == self.max_retries:
+                    raise
+                print(f'Retrying part {byte_range} of {upload_id}: {ce}')
+                time.sleep(min(5, 0.5 * 2 ** (attempt - 1)))
+
+### EOF
@@ -0,0 +1,125 @@
+# input_cache.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Local cache of downloaded input files keyed by bucket/key/ETag, so
+# redelivered and retried messages do not download the same input again
+##
+
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+'''
+reference:
+    1. head object: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+    2. transfer config: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+'''
+
+class InputCache:
+    '''
+    Size-capped LRU cache of S3 inputs on local disk
+    input:
+        s3: boto3 S3 client
+        root: cache folder, should be on the same filesystem as DATA_PATH so
+              cached files can be hard linked into job folders
+        max_bytes: cache size cap
+        transfer_config: TransferConfig used for downloads
+    '''
+    def __init__(self, s3, root, max_bytes, transfer_config=None):
+        self.s3 = s3
+        self.root = root
+        self.max_bytes = max_bytes
+        self.transfer_config = transfer_config
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(root, exist_ok=True)
+
+        #rebuild the LRU order from access times left by a previous run
+        files = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.startswith('tmp-'):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_atime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    def fetch(self, bucket, key, filename):
+        '''
+        Put the input at filename, downloading it only when the cache has no
+        copy of this bucket/key/ETag
+        output:
+            hit: True when the download was skipped
+        '''
+        etag = self.s3.head_object(Bucket=bucket, Key=key)['ETag']
+        name = hashlib.sha256(f'{bucket}/{key}/{etag}'.encode()).hexdigest()
+        path = os.path.join(self.root, name)
+
+        with self.lock:
+            hit = name in self.entries and os.path.exists(path)
+            if hit:
+                self.entries.move_to_end(name)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if hit:
+            os.utime(path)
+        else:
+            tmp = os.path.join(self.root, f'tmp-{uuid.uuid4()}')
+            try:
+                self.s3.download_file(bucket, key, tmp, Config=self.transfer_config)
+                os.replace(tmp, path)
+
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+            self._add(name, os.path.getsize(path))
+
+        self._place(path, filename)
+        return hit
+
+    def _add(self, name, size):
+        with self.lock:
+            self.size += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+
+            #evict least recently used entries, never the one just added
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                try:
+                    os.remove(os.path.join(self.root, old))
+                except FileNotFoundError:
+                    pass
+
+    def _place(self, path, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        #hard link when possible; job folders never modify their input
+        try:
+            os.link(path, filename)
+        except OSError:
+            shutil.copyfile(path, filename)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+### EOF
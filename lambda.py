@@ -1,31 +1,55 @@
 import json
-import boto3
-dynamo = boto3.resource('dynamodb', region_name="us-east-1")
-ann_table = dynamo.Table('mli628_annotations')
-glacier_client = boto3.client('glacier', region_name ="us-east-1")
-s3_client = boto3.client('s3', region_name = "us-east-1")
-from boto3.dynamodb.conditions import Attr
-from botocore.exceptions import ClientError
-sqs_client = boto3.client('sqs', region_name = "us-east-1")
-RESTORE_SQS = "https://sqs.us-east-1.amazonaws.com/127134666975/mli628-a16-restore"
+import os
+import aws_clients
+from result_codec import DecompressedReader
+#nothing here talks to AWS or imports boto3 until the first invocation needs a
+#client; clients then live in the execution environment and are reused by
+#warm invocations
+#AWS_REGION_NAME in the environment overrides the default region
+aws_clients.configure(**{'region_name': "us-east-1", **aws_clients.from_mapping(os.environ)})
+ann_table = aws_clients.table(os.environ.get('ANN_TABLE', 'mli628_annotations'))
+glacier_client = aws_clients.LazyClient('glacier')
+s3_client = aws_clients.LazyClient('s3')
+sqs_client = aws_clients.LazyClient('sqs')
+RESTORE_SQS = os.environ.get('RESTORE_SQS', "https://sqs.us-east-1.amazonaws.com/127134666975/mli628-a16-restore")
+#botocore and the acker are loaded by the first invocation, see load()
+ClientError = None
+acker = None
 '''
 get_job_output: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
-scan: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/scan.html
+query: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/query.html
 delete archive: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/delete_archive.html
 '''
 
+def load():
+    global ClientError, acker
+    if acker is None:
+        from botocore.exceptions import ClientError
+        from sqs_ack import BatchAcker
+        #restored messages are deleted in one batch when the invocation ends
+        acker = BatchAcker(sqs_client, RESTORE_SQS, max_age=0)
+
 def lambda_handler(event, context):
     
+    load()
     archive_del = False
     messages = sqs_client.receive_message(QueueUrl = RESTORE_SQS,
                             MaxNumberOfMessages= 10)
                             
+    try:
+        restore_messages(messages)
+    finally:
+        acker.flush()
+
+
+def restore_messages(messages):
     if 'Messages' in messages:
         
         for mes in messages['Messages']:
             receipt_handle = mes['ReceiptHandle']
 
-            sqs_message = json.loads(mes['Records'][0]['body'])
+            #receive_message returns the SNS envelope as the message body
+            sqs_message = json.loads(mes['Body'])
             message = json.loads(sqs_message['Message'])
 
             #getting variables
@@ -34,91 +58,178 @@ def lambda_handler(event, context):
             vault_arn = message.get('VaultARN')
             vault_name = vault_arn.split(':')[-1].split('/')[-1]
             archive_job_id = message.get('JobId')
-            user_id = message.get('JobDescription')
+            #'user_id' restores every result in the retrieval; 'user_id/job_id' (older retrievals) just that job
+            user_id, _, job_id = message.get('JobDescription').partition('/')
+            byte_range = message.get('RetrievalByteRange')
+
+            #every result still held in this archive, read once for the whole pack
+            jobs = archived_jobs(user_id, archive_id)
 
             try:
-                job_id, bucket, file_key = restore_file(user_id, vault_name, archive_job_id)
+                restored = restore_file(jobs, job_id, vault_name, archive_job_id, byte_range)
             except Exception as e:
                 raise Exception("Unexpected error when restoring file")
 
 
             #clean up
             try:
-                clean_up(bucket, file_key, vault_name, archive_id, job_id)
+                cleaned = sum(clean_up(job.get('s3_results_bucket'), job.get('s3_key_result_file'),
+                                       job.get('job_id')) for job in restored)
             except Exception as e:
                 raise Exception("Unexpected error when cleaning up file")
-            
-            #delete message from sqs
-            try:
-                sqs_client.delete_message(QueueUrl=RESTORE_SQS, ReceiptHandle=receipt_handle)
-
-            except ClientError as ce:
-                print(f'Fail to delete message: {ce}')
 
-            except Exception as e:
-                print(f'Unexpected error: {e}')
+            #a pack is deleted only once none of its members is still archived
+            remaining = len(jobs) - cleaned
+            if remaining:
+                print(f'archive {archive_id} still holds {remaining} other results')
+            else:
+                delete_archive(vault_name, archive_id)
+            
+            #delete message from sqs, batched until the invocation ends
+            acker.ack(receipt_handle)
             
             print('completed')
 
 
-def restore_file(user_id, vault_name, archive_job_id):
-    
-    #getting the job info
-    response = ann_table.query(
-            IndexName = 'user_id_index', 
-            ProjectionExpression = 'results_file_archive_id, s3_key_result_file, s3_results_bucket, job_id',
-            KeyConditionExpression = 'user_id = :user',
-            ExpressionAttributeValues = {':user': user_id})
-            
-    job = response['Items'][0]
-    file_key = job.get('s3_key_result_file')
-    bucket = job.get('s3_results_bucket')
-    job_id = job.get('job_id')
-    
+class RangeReader:
+    '''
+    Reads the members of one retrieved range in offset order, skipping
+    whatever lies between them
+    '''
+    def __init__(self, body, start):
+        self.body = body
+        self.position = start
+        self.end = None
+
+    def seek(self, offset, length):
+        #offset None reads the rest of the body as one file
+        if offset is None:
+            self.end = None
+            return self
+        while self.position < offset:
+            skipped = len(self.body.read(min(offset - self.position, 1024 * 1024)))
+            if not skipped:
+                break
+            self.position += skipped
+        self.end = offset + length
+        return self
+
+    def read(self, size=-1):
+        if self.end is None:
+            data = self.body.read(size) if size >= 0 else self.body.read()
+        elif self.end <= self.position:
+            return b''
+        else:
+            left = self.end - self.position
+            data = self.body.read(left if size < 0 else min(size, left))
+        self.position += len(data)
+        return data
+
+
+def archived_jobs(user_id, archive_id):
+    #packs are per user, so only this user's jobs can point at it
+    kwargs = {'IndexName': 'user_id_index',
+              'ProjectionExpression': 'job_id, s3_key_result_file, s3_results_bucket, '
+                                      'archive_offset, archive_length, archive_codec',
+              'KeyConditionExpression': 'user_id = :user',
+              'FilterExpression': 'results_file_archive_id = :a',
+              'ExpressionAttributeValues': {':user': user_id, ':a': archive_id}}
+    jobs = []
+    while True:
+        response = ann_table.query(**kwargs)
+        jobs.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return jobs
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def restore_file(jobs, job_id, vault_name, archive_job_id, byte_range):
+    '''
+    Restore the results of jobs held in the retrieved range from one read
+    of the job output
+    input:
+        job_id: restore only this job, for retrievals that name one
+    output:
+        the jobs whose results are back in s3
+    '''
+    range_start, range_end = 0, None
+    if byte_range:
+        range_start, range_end = (int(b) for b in byte_range.split('-'))
+
+    members = []
+    for job in jobs:
+        if job_id and job.get('job_id') != job_id:
+            continue
+        #a packed result is cut out of the retrieved range; a whole archive is the file
+        offset = job.get('archive_offset')
+        if offset is not None:
+            offset, length = int(offset), int(job.get('archive_length'))
+            if offset < range_start or (range_end is not None and offset + length > range_end + 1):
+                continue
+        members.append((offset, job))
+    #the body is read once, front to back
+    members.sort(key=lambda member: -1 if member[0] is None else member[0])
+    if not members:
+        return []
+
     retri_file = glacier_client.get_job_output(
                     vaultName=vault_name,
                     jobId=archive_job_id)
+    body = RangeReader(retri_file.get('body'), range_start)
+
+    restored = []
+    for offset, job in members:
+        if offset is not None and offset < body.position:
+            print(f"{job.get('job_id')} overlaps the result before it, skipped")
+            continue
+        file = body.seek(offset, None if offset is None else int(job.get('archive_length')))
+
+        #compressed members are decompressed as they stream back
+        codec = job.get('archive_codec', 'none')
+        if codec != 'none':
+            file = DecompressedReader(file, codec)
+
+        #restore the file, streamed to s3
+        try:
+            s3_client.upload_fileobj(file, job.get('s3_results_bucket'), job.get('s3_key_result_file'))
+            restored.append(job)
+            
+        except ClientError as ce:
+            print(ce)
+            
+        except Exception as e:
+            print(e)
     
-    #restore the file
-    file = retri_file.get('body').read()
-    try:
-        s3_client.put_object(Bucket=bucket, Key=file_key, Body=file)
-        
-    except ClientError as ce:
-        print(ce)
-        
-    except Exception as e:
-        print(e)
-    
-    return job_id, bucket, file_key
+    return restored
     
-def clean_up(bucket, file_key, vault_name, archive_id, job_id):
-     #if the file is restored, delete archive_id and archive file
-    restore_file = s3_client.get_object(Bucket=bucket, Key=file_key)
+def clean_up(bucket, file_key, job_id):
+     #if the file is restored, drop the job's archive reference
+    restore_file = s3_client.head_object(Bucket=bucket, Key=file_key)
 
-    if restore_file.get('Body'):
+    if restore_file.get('ContentLength') is not None:
         try:
-            glacier_client.delete_archive(
-                vaultName=vault_name,
-                archiveId=archive_id)
-            archive_del = True
-                
+            ann_table.update_item(Key = {"job_id": job_id},
+                      UpdateExpression = 'Remove results_file_archive_id, archive_offset, archive_length, archive_size, '
+                                         'archive_codec, archive_raw_length')
+            return True
+            
         except ClientError as ce:
-            print(f'Failed to delete archived file:{ce}')
-        
+            print(f'Failed to remove archived id:{ce}')
+    
         except Exception as e:
-            print(f'Failed to delete archived file unexpectedly:{e}')
-        
-        if archive_del:
-            try:
-                ann_table.update_item(Key = {"job_id": job_id},
-                          UpdateExpression = 'Remove results_file_archive_id')
-                
-            except ClientError as ce:
-                print(f'Failed to remove archived id:{ce}')
-        
-            except Exception as e:
-                print(f'Failed to remove archived id unexpectedly:{e}')
+            print(f'Failed to remove archived id unexpectedly:{e}')
 
+    return False
+
+
+def delete_archive(vault_name, archive_id):
+    try:
+        glacier_client.delete_archive(
+            vaultName=vault_name,
+            archiveId=archive_id)
+            
+    except ClientError as ce:
+        print(f'Failed to delete archived file:{ce}')
     
-        
\ No newline at end of file
+    except Exception as e:
+        print(f'Failed to delete archived file unexpectedly:{e}')
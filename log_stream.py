@@ -0,0 +1,91 @@
+# log_stream.py
+#
+# Bounded-memory reads of annotation logs in S3: byte-range pages, tails
+# and chunked (optionally gzip-compressed) streams
+##
+
+import zlib
+
+'''
+reference:
+    1. range get: https://docs.aws.amazon.com/AmazonS3/latest/userguide/range-get-olap.html
+    2. get_object: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+    3. zlib compressobj: https://docs.python.org/3/library/zlib.html#zlib.compressobj
+'''
+
+CHUNK_SIZE = 64 * 1024
+#wbits for a gzip header and trailer instead of a raw zlib stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def object_size(s3, bucket, key):
+    return s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+def page_range(size, offset=0, tail=None, limit=None):
+    '''
+    input:
+        size: object size in bytes
+        offset: first byte of the page
+        tail: read the last tail bytes instead of starting at offset; a tail
+              longer than limit still ends at the end of the log
+        limit: most bytes in the page (None = to the end)
+    output:
+        (start, end): end is exclusive; start == end for an empty page
+    '''
+    if tail is not None:
+        start = max(0, size - (tail if limit is None else min(tail, limit)))
+    else:
+        start = min(max(0, offset), size)
+
+    end = size if limit is None else min(size, start + limit)
+    return start, end
+
+def open_range(s3, bucket, key, start, end):
+    '''
+    output:
+        the streaming body of bytes [start, end), or None for an empty range
+    '''
+    if end <= start:
+        return None
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end - 1}')
+    return response['Body']
+
+def iter_body(body, chunk_size=CHUNK_SIZE):
+    if body is None:
+        return
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+def read_page(s3, bucket, key, start, end, skip_partial_line=False):
+    '''
+    Read one page as text; a multi-byte character cut by the range shows
+    as U+FFFD rather than failing the page
+    input:
+        skip_partial_line: drop everything up to the first newline, for a
+                           tail that starts mid-line
+    output:
+        (text, start): start moves forward past any skipped partial line
+    '''
+    data = b''.join(iter_body(open_range(s3, bucket, key, start, end)))
+    if skip_partial_line and start > 0:
+        newline = data.find(b'\n')
+        if newline != -1:
+            start += newline + 1
+            data = data[newline + 1:]
+
+    return data.decode('utf-8', errors='replace'), start
+
+def gzip_chunks(chunks, level=6):
+    '''
+    Compress a stream of chunks into one gzip member without buffering it
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+### EOF
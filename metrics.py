@@ -0,0 +1,176 @@
+# metrics.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Per-stage latency histograms and gauges for the annotator, exposed on a
+# local scrape endpoint and/or dumped to a JSON file periodically
+##
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+reference:
+    1. prometheus text format: https://prometheus.io/docs/instrumenting/exposition_formats/
+    2. http.server: https://docs.python.org/3/library/http.server.html
+'''
+
+#upper bounds in seconds, from an SQS delete to a whole-genome annotation
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           300, 900, 3600, float('inf'))
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        #upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    '''
+    input:
+        prefix: prefix of every exported metric name
+        log: print one JSON line per timed stage
+    '''
+    def __init__(self, prefix='gas_annotator', log=True):
+        self.prefix = prefix
+        self.log = log
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.gauges = {}
+
+    def observe(self, stage, seconds, job_id=None):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+        if self.log:
+            print(json.dumps({'event': 'stage', 'stage': stage, 'job_id': job_id,
+                              'seconds': round(seconds, 6)}))
+
+    @contextmanager
+    def timer(self, stage, job_id=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, job_id)
+
+    def gauge(self, name, fn):
+        '''
+        Register a gauge read from fn() at export time
+        '''
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {stage: h.snapshot() for stage, h in self.histograms.items()}
+
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                gauges[name] = None
+                print(f'Fail to read gauge {name}: {e}')
+
+        return {'time': int(time.time()), 'stages': histograms, 'gauges': gauges}
+
+    def prometheus(self):
+        lines = []
+        name = f'{self.prefix}_stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                seen = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    seen += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {seen}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+
+        for gauge, value in sorted(self.snapshot()['gauges'].items()):
+            if value is not None:
+                lines.append(f'# TYPE {self.prefix}_{gauge} gauge')
+                lines.append(f'{self.prefix}_{gauge} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        '''
+        Scrape endpoint: /metrics (prometheus text) and /metrics.json
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f'Metrics on http://{host}:{port}/metrics')
+        return server
+
+    def dump_every(self, path, interval):
+        '''
+        Overwrite path with a JSON snapshot every interval seconds
+        '''
+        def dump():
+            while True:
+                time.sleep(interval)
+                try:
+                    with open(path + '.tmp', 'w') as f:
+                        json.dump(self.snapshot(), f)
+                    os.replace(path + '.tmp', path)
+                except OSError as oe:
+                    print(f'Fail to dump metrics: {oe}')
+
+        threading.Thread(target=dump, daemon=True).start()
+
+### EOF
@@ -0,0 +1,106 @@
+# receive_policy.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Decides how many messages the annotator asks SQS for and how long it
+# long-polls, and backs off while the host is saturated
+##
+
+import os
+import shutil
+import time
+
+'''
+reference:
+    1. receive message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
+    2. load average: https://docs.python.org/3/library/os.html#os.getloadavg
+    3. MemAvailable: https://man7.org/linux/man-pages/man5/proc.5.html
+'''
+
+def free_memory_mb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+
+    except OSError:
+        pass
+
+    return None
+
+
+class ReceivePolicy:
+    '''
+    input:
+        settings: AnnConfig
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.cpus = os.cpu_count() or 1
+        self.backoff = 0
+        self.last_requested = 0
+        self.last_received = 0
+
+    def pressure(self):
+        '''
+        output:
+            reason the host cannot take more work, or None
+        '''
+        load = os.getloadavg()[0] / self.cpus
+        if load > self.settings.max_load:
+            return f'load {load:.2f} per core'
+
+        memory = free_memory_mb()
+        if memory is not None and memory < self.settings.min_free_memory:
+            return f'{memory} MB memory free'
+
+        try:
+            disk = shutil.disk_usage(self.settings.data_path).free // (1024 * 1024)
+        except OSError:
+            #DATA_PATH is created with the first job
+            disk = None
+
+        if disk is not None and disk < self.settings.min_free_disk:
+            return f'{disk} MB disk free'
+
+        return None
+
+    def wait_for_capacity(self):
+        '''
+        Sleep with exponential backoff while the host is saturated
+        '''
+        while True:
+            reason = self.pressure()
+            if reason is None:
+                self.backoff = 0
+                return
+
+            self.backoff = min(self.settings.backoff_max, max(1, self.backoff * 2))
+            print(f'Backing off {self.backoff}s: {reason}')
+            time.sleep(self.backoff)
+
+    def next_receive(self, free):
+        '''
+        input:
+            free: annotation slots free right now
+        output:
+            max_messages, wait_time for receive_message; max_messages is 0
+            when nothing should be received
+        '''
+        max_messages = min(free, self.settings.max_messages)
+
+        #a full batch means a burst: come straight back for more; an empty one
+        #means the queue is quiet: long-poll as long as allowed
+        if self.last_requested and self.last_received == self.last_requested:
+            wait_time = 1
+        else:
+            wait_time = self.settings.wait_time
+
+        return max_messages, wait_time
+
+    def observe(self, requested, received):
+        self.last_requested = requested
+        self.last_received = received
+
+### EOF
@@ -0,0 +1,121 @@
+# result_codec.py
+#
+# Streaming compression of result files on their way into Glacier and
+# decompression on their way back. Each result is compressed on its own
+# (one gzip member or zstd frame), so a result inside a pack can still be
+# retrieved and decompressed by itself. It must be packaged with the
+# restore lambda (zstd also needs the zstandard package there)
+##
+
+import time
+import zlib
+
+'''
+reference:
+    1. zlib compressobj: https://docs.python.org/3/library/zlib.html#zlib.compressobj
+    2. zstandard streaming: https://python-zstandard.readthedocs.io/en/latest/compressor.html#compressobj
+'''
+
+CODECS = ('none', 'gzip', 'zstd')
+CHUNK = 1024 * 1024
+#wbits for a gzip header and trailer
+GZIP_WBITS = 31
+
+def check(codec):
+    if codec not in CODECS:
+        raise ValueError(f'unknown codec {codec}, expected one of {", ".join(CODECS)}')
+    if codec == 'zstd':
+        #fail at startup rather than on the first result
+        import zstandard
+
+def compressor(codec, level=None):
+    '''
+    output:
+        object with compress(data) and flush(), or None for 'none'
+    '''
+    if codec == 'gzip':
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, GZIP_WBITS)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    return None
+
+def decompressor(codec):
+    '''
+    output:
+        object with decompress(data), or None for 'none'
+    '''
+    if codec == 'gzip':
+        return zlib.decompressobj(GZIP_WBITS)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+class CompressedReader:
+    '''
+    File-like view of body compressed with codec, read a chunk at a time
+    '''
+    def __init__(self, body, codec, level=None, chunk=CHUNK):
+        self.body = body
+        self.codec = compressor(codec, level)
+        self.chunk = chunk
+        self.buffer = b''
+        self.done = False
+        self.raw_bytes = 0
+        self.seconds = 0.0
+
+    def fill(self, size):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            data = self.body.read(self.chunk)
+            start = time.perf_counter()
+            if data:
+                self.raw_bytes += len(data)
+                self.buffer += self.codec.compress(data) if self.codec else data
+            else:
+                self.done = True
+                if self.codec:
+                    self.buffer += self.codec.flush()
+            self.seconds += time.perf_counter() - start
+
+    def read(self, size=-1):
+        self.fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.body.close()
+
+
+class DecompressedReader:
+    '''
+    File-like view of a compressed body, decompressed as it is read
+    '''
+    def __init__(self, body, codec, chunk=CHUNK):
+        self.body = body
+        self.codec = decompressor(codec)
+        self.chunk = chunk
+        self.buffer = b''
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            data = self.body.read(self.chunk)
+            if not data:
+                self.done = True
+            elif self.codec:
+                self.buffer += self.codec.decompress(data)
+            else:
+                self.buffer += data
+
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+### EOF
@@ -0,0 +1,130 @@
+# result_index.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Index from input content hash + annotator version to the S3 keys of an
+# earlier result, so identical uploads are not annotated twice
+#
+# usage: python result_index.py <table> <region> <current version>
+#        deletes every entry made by another annotator version
+##
+
+import hashlib
+import sys
+import threading
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+'''
+reference:
+    1. hashlib file digest: https://docs.python.org/3/library/hashlib.html
+    2. batch writer: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/dynamodb.html#batch-writing
+'''
+
+def hash_file(filename, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultIndex:
+    '''
+    DynamoDB table keyed by `content_key` = <sha256 of input>:<annotator version>
+    input:
+        table: boto3 DynamoDB Table
+        version: annotator version; bumping it makes every older entry miss
+    '''
+    def __init__(self, table, version):
+        self.table = table
+        self.version = version
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def content_key(self, digest):
+        return f'{digest}:{self.version}'
+
+    def lookup(self, digest):
+        '''
+        output:
+            item: earlier result with s3_results_bucket, s3_key_result_file and
+                  s3_key_log_file, or None
+        '''
+        try:
+            item = self.table.get_item(Key={'content_key': self.content_key(digest)}).get('Item')
+
+        except ClientError as ce:
+            print(f'Fail to read result index: {ce}')
+            item = None
+
+        with self.lock:
+            if item:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return item
+
+    def record(self, digest, bucket, result_key, log_key, job_id):
+        try:
+            self.table.put_item(Item={'content_key': self.content_key(digest),
+                                      'annotator_version': self.version,
+                                      's3_results_bucket': bucket,
+                                      's3_key_result_file': result_key,
+                                      's3_key_log_file': log_key,
+                                      'job_id': job_id,
+                                      'create_time': int(time.time())})
+
+        except ClientError as ce:
+            print(f'Fail to update result index: {ce}')
+
+    def forget(self, digest):
+        #the indexed result is gone (e.g. archived), so annotate again next time
+        try:
+            self.table.delete_item(Key={'content_key': self.content_key(digest)})
+
+        except ClientError as ce:
+            print(f'Fail to remove result index entry: {ce}')
+
+    def invalidate(self):
+        '''
+        Delete every entry made by another annotator version, e.g. after an
+        anntools upgrade
+        output:
+            removed: number of entries deleted
+        '''
+        removed = 0
+        kwargs = {'ProjectionExpression': 'content_key',
+                  'FilterExpression': Attr('annotator_version').ne(self.version)}
+
+        with self.table.batch_writer() as batch:
+            while True:
+                response = self.table.scan(**kwargs)
+                for item in response['Items']:
+                    batch.delete_item(Key={'content_key': item['content_key']})
+                    removed += 1
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        return removed
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+
+if __name__ == '__main__':
+    table_name, region, version = sys.argv[1:4]
+    table = boto3.resource('dynamodb', region_name=region).Table(table_name)
+    print(f'removed {ResultIndex(table, version).invalidate()} entries')
+
+### EOF
@@ -0,0 +1,107 @@
+# sharding.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Splits large VCF inputs into header-preserving shards and merges the
+# annotated shards back into one result file and one log
+##
+
+import os
+
+#file names anntools writes next to its input
+ANNOT_SUFFIX = '.annot.vcf'
+LOG_SUFFIX = '.count.log'
+
+#command run for each shard: annotate only, uploading is done once after the merge
+SHARD_CODE = ("import sys; sys.path.extend(sys.argv[2:]); import driver; "
+              "driver.run(sys.argv[1], 'vcf')")
+
+'''
+reference:
+    1. VCF header and record layout: https://samtools.github.io/hts-specs/VCFv4.2.pdf
+'''
+
+def annot_file(filename):
+    return filename.replace('.vcf', ANNOT_SUFFIX)
+
+def log_file(filename):
+    return filename + LOG_SUFFIX
+
+def should_shard(filename, min_bytes):
+    '''
+    Only inputs of at least min_bytes are sharded; 0 turns sharding off
+    '''
+    return min_bytes > 0 and os.path.getsize(filename) >= min_bytes
+
+def split_vcf(filename, out_dir, by='records', records_per_shard=500000):
+    '''
+    Split a VCF into shards that each carry the full header
+    input:
+        filename: VCF to split
+        out_dir: folder for the shards
+        by: 'records' starts a new shard every records_per_shard records,
+            'chrom' starts one whenever the chromosome changes (or the shard
+            reaches records_per_shard)
+    output:
+        shards: shard paths in original order
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.basename(filename)[:-len('.vcf')]
+    header, shards = [], []
+    out, count, chrom = None, 0, None
+
+    with open(filename) as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                header.append(line)
+                continue
+
+            record_chrom = line.split('\t', 1)[0]
+            if (out is None or count >= records_per_shard
+                    or (by == 'chrom' and record_chrom != chrom)):
+                if out:
+                    out.close()
+                shard = os.path.join(out_dir, f'{base}.shard{len(shards):05d}.vcf')
+                shards.append(shard)
+                out = open(shard, 'w')
+                out.writelines(header)
+                count = 0
+
+            out.write(line)
+            count += 1
+            chrom = record_chrom
+
+    if out:
+        out.close()
+
+    return shards
+
+def merge_outputs(shards, filename):
+    '''
+    Merge annotated shards back in shard order
+    input:
+        shards: shard paths as returned by split_vcf
+        filename: original input; results go where anntools would put them
+    output:
+        result_file, log: merged annotated VCF and log
+    '''
+    result_file, log = annot_file(filename), log_file(filename)
+
+    with open(result_file, 'w') as out:
+        for i, shard in enumerate(shards):
+            with open(annot_file(shard)) as part:
+                for line in part:
+                    #header comes from the first shard only
+                    if i and line.startswith('#'):
+                        continue
+                    out.write(line)
+
+    with open(log, 'w') as out:
+        for i, shard in enumerate(shards):
+            out.write(f'### shard {i}: {os.path.basename(shard)}\n')
+            with open(log_file(shard)) as part:
+                out.write(part.read())
+
+    return result_file, log
+
+### EOF
@@ -0,0 +1,287 @@
+# sns_outbox.py
+#
+# Transactional outbox for job requests: the web request writes the job
+# with a dispatch marker and returns; a background dispatcher publishes
+# the jobs to SNS in batches, retries failures and clears the marker
+##
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+'''
+reference:
+    1. transactional outbox: https://microservices.io/patterns/data/transactional-outbox.html
+    2. publish batch: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish_batch.html
+    3. condition expressions: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+    4. sparse indexes: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/bp-indexes-general-sparse-indexes.html
+'''
+
+SNS_MAX_BATCH = 10
+#set on an item until its message is published; holds the time it was written
+MARKER = 'dispatch_pending'
+
+def to_json(value):
+    #items read back from DynamoDB carry Decimals
+    if isinstance(value, Decimal):
+        return int(value) if value == int(value) else float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class Outbox:
+    '''
+    input:
+        sns: boto3 SNS client
+        topic_arn: topic the jobs are published to
+        table: boto3 DynamoDB Table holding the jobs
+        key: partition key of the table
+        max_batch: publish at this many queued jobs (at most 10)
+        max_wait: or once the oldest queued job has waited this many seconds
+        max_retries: publish attempts per dispatch; jobs still failing are
+                     dispatched again after retry_base seconds, doubling
+                     per round up to max_backoff, until they are published
+        sweep_interval: seconds between sweeps for jobs whose marker is older
+                        than sweep_age (lost by a restart); 0 turns the sweep off
+        index: sparse index on MARKER, holding only undispatched jobs; without
+               one the sweep scans the whole table
+    '''
+    def __init__(self, sns, topic_arn, table, key='job_id', max_batch=SNS_MAX_BATCH, max_wait=0.05,
+                 max_retries=5, sweep_interval=60, sweep_age=120, index=None, retry_base=1,
+                 max_backoff=300):
+        self.sns = sns
+        self.topic_arn = topic_arn
+        self.table = table
+        self.key = key
+        self.max_batch = min(max_batch, SNS_MAX_BATCH)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.sweep_interval = sweep_interval
+        self.sweep_age = sweep_age
+        self.index = index
+        self.retry_base = retry_base
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_sweep = time.time()
+        #key -> (due, rounds, item) of jobs waiting to be dispatched again; dispatcher thread only
+        self.retrying = {}
+        if sweep_interval and not index:
+            print('Outbox sweep scans the whole table: no sparse dispatch index configured')
+        self.published = 0
+        self.failed = 0
+        self.calls = 0
+        self.swept = 0
+
+    def submit(self, item):
+        '''
+        Write the item with its dispatch marker and queue it for publishing;
+        the only call on the request path
+        '''
+        self.table.put_item(Item=dict(item, **{MARKER: int(time.time())}))
+        self.enqueue(item)
+
+    def submit_many(self, items, workers=16):
+        '''
+        Write each item that does not exist yet with a conditional put,
+        `workers` at a time, and queue each one as it is written. An existing
+        item is never overwritten, so a retried call only adds what is missing
+        output:
+            keys of the items that already existed
+        '''
+        marked = int(time.time())
+
+        def put(item):
+            try:
+                self.table.put_item(Item=dict(item, **{MARKER: marked}),
+                                    ConditionExpression=f'attribute_not_exists({self.key})')
+            except ClientError as ce:
+                if ce.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                return False
+            self.enqueue(item)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as pool:
+            written = list(pool.map(put, items))
+        return [item[self.key] for item, new in zip(items, written) if not new]
+
+    def enqueue(self, item):
+        with self.lock:
+            #the dispatcher starts with the first job, not at import
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.queue.put(item)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.wait_time())]
+            except queue.Empty:
+                batch = []
+
+            deadline = time.time() + self.max_wait
+            while batch and len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self.send(batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+            #failed jobs whose backoff is over
+            now = time.time()
+            due = [item for when, _, item in self.retrying.values() if when <= now]
+            for start in range(0, len(due), self.max_batch):
+                self.send(due[start:start + self.max_batch])
+
+            if self.sweep_interval and time.time() - self.last_sweep >= self.sweep_interval:
+                self.last_sweep = time.time()
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f'Fail to sweep the outbox: {e}')
+
+    def wait_time(self):
+        #until the next sweep or the next retry is due, whichever is first
+        waits = []
+        if self.sweep_interval:
+            waits.append(self.last_sweep + self.sweep_interval - time.time())
+        if self.retrying:
+            waits.append(min(when for when, _, _ in self.retrying.values()) - time.time())
+        return max(0, min(waits)) if waits else None
+
+    def send(self, batch):
+        '''
+        Dispatch a batch; jobs that still fail are kept for another round
+        after a backoff, so a failed publish is not left to a restart
+        '''
+        try:
+            failed = self.dispatch(batch)
+        except Exception as e:
+            print(f'Fail to dispatch {len(batch)} jobs: {e}')
+            failed = batch
+
+        failed_keys = {item[self.key] for item in failed}
+        for item in batch:
+            key = item[self.key]
+            if key not in failed_keys:
+                self.retrying.pop(key, None)
+                continue
+            rounds = self.retrying[key][1] + 1 if key in self.retrying else 1
+            delay = min(self.max_backoff, self.retry_base * 2 ** (rounds - 1))
+            self.retrying[key] = (time.time() + delay, rounds, item)
+
+    def dispatch(self, items):
+        '''
+        Publish up to max_batch items in one publish_batch call, retrying
+        failed entries with exponential backoff; published items get their
+        marker cleared
+        output:
+            failed: items to dispatch again
+        '''
+        pending = {str(i): item for i, item in enumerate(items)}
+
+        for attempt in range(self.max_retries):
+            if attempt:
+                time.sleep(min(5, 0.1 * 2 ** attempt))
+
+            entries = [{'Id': id, 'Message': json.dumps(item, default=to_json)}
+                       for id, item in pending.items()]
+            try:
+                self.calls += 1
+                response = self.sns.publish_batch(TopicArn=self.topic_arn,
+                                                  PublishBatchRequestEntries=entries)
+            except ClientError as ce:
+                print(f'Fail to publish {len(entries)} jobs: {ce}')
+                continue
+
+            for entry in response.get('Successful', []):
+                self.published += 1
+                self.clear(pending.pop(entry['Id']))
+
+            for entry in response.get('Failed', []):
+                if entry.get('SenderFault'):
+                    #the message itself is bad; retrying will not help
+                    item = pending.pop(entry['Id'])
+                    self.failed += 1
+                    print(f'Fail to publish job {item[self.key]}: {entry.get("Code")} {entry.get("Message")}')
+
+            if not pending:
+                return []
+
+        self.failed += len(pending)
+        print(f'Fail to publish jobs after {self.max_retries} attempts: '
+              f'{[item[self.key] for item in pending.values()]}')
+        return list(pending.values())
+
+    def clear(self, item):
+        try:
+            self.table.update_item(Key={self.key: item[self.key]},
+                                   UpdateExpression=f'REMOVE {MARKER}',
+                                   ConditionExpression=f'attribute_exists({self.key})')
+        except ClientError as ce:
+            #the sweep publishes it again; the annotator claims a job (PENDING to
+            #RUNNING) before starting it, so a second delivery is dropped
+            print(f'Fail to clear dispatch marker of {item[self.key]}: {ce}')
+
+    def sweep(self):
+        '''
+        Re-queue PENDING jobs whose marker is older than sweep_age, read
+        from the sparse index, or the whole table without one
+        '''
+        kwargs = {'FilterExpression': Attr(MARKER).lt(int(time.time()) - self.sweep_age)}
+        if self.index:
+            kwargs['IndexName'] = self.index
+
+        found = 0
+        while True:
+            response = self.table.scan(**kwargs)
+            for item in response.get('Items', []):
+                found += 1
+                if item.get('job_status', 'PENDING') != 'PENDING':
+                    #picked up by the annotator, only the marker is left
+                    self.clear(item)
+                    continue
+                if item[self.key] in self.retrying:
+                    #already coming round again
+                    continue
+                item.pop(MARKER, None)
+                self.queue.put(item)
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        self.swept += found
+        return found
+
+    def drain(self, timeout=None):
+        '''
+        Wait until every queued job has been dispatched and none is waiting
+        to be retried (for shutdown and benchmarks)
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while self.queue.unfinished_tasks or self.retrying:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'published': self.published, 'failed': self.failed,
+                'calls': self.calls, 'swept': self.swept, 'retrying': len(self.retrying)}
+
+### EOF
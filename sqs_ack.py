@@ -0,0 +1,140 @@
+# sqs_ack.py
+#
+# Batched SQS acknowledgement shared by the annotator, the archive app and
+# the restore lambda
+##
+
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+'''
+reference:
+    1. delete message batch: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message_batch.html
+'''
+
+SQS_MAX_BATCH = 10
+
+class BatchAcker:
+    '''
+    Collects receipt handles and deletes them with delete_message_batch once
+    max_batch are pending or the oldest has waited max_age seconds. Failed
+    entries are retried up to max_retries times unless SQS says the handle
+    itself is bad.
+    input:
+        sqs: boto3 SQS client
+        queue_url: queue the handles belong to
+        max_batch: flush at this many pending handles (at most 10)
+        max_age: flush when the oldest pending handle is this old; 0 means the
+                 caller flushes (e.g. at the end of a lambda invocation)
+        max_retries: attempts per handle before it is reported as failed
+        observe: optional callback given the seconds each batch call took
+    '''
+    def __init__(self, sqs, queue_url, max_batch=SQS_MAX_BATCH, max_age=1.0, max_retries=3,
+                 observe=None):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.max_batch = min(max_batch, SQS_MAX_BATCH)
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.observe = observe
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.oldest = None
+        self.thread = None
+        self.acked = 0
+        self.failed = 0
+        self.calls = 0
+
+    def ack(self, receipt_handle):
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.time()
+            self.pending.append((receipt_handle, 0))
+            full = len(self.pending) >= self.max_batch
+
+            #the age flusher starts with the first ack, not at import
+            if self.max_age and self.thread is None:
+                self.thread = threading.Thread(target=self._flush_by_age, daemon=True)
+                self.thread.start()
+
+        if full:
+            self.flush()
+
+    def _flush_by_age(self):
+        while True:
+            time.sleep(self.max_age / 2)
+            with self.lock:
+                due = self.pending and time.time() - self.oldest >= self.max_age
+            if due:
+                self.flush()
+
+    def flush(self):
+        '''
+        Delete everything pending, retrying failed entries
+        output:
+            failed: receipt handles that could not be deleted
+        '''
+        failed = []
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = self.pending[:SQS_MAX_BATCH]
+                    del self.pending[:SQS_MAX_BATCH]
+                    self.oldest = time.time() if self.pending else None
+
+                if not batch:
+                    break
+
+                retry, dropped = self._delete(batch)
+                failed += dropped
+                if retry:
+                    with self.lock:
+                        self.pending[:0] = retry
+                        self.oldest = self.oldest or time.time()
+                    time.sleep(0.1 * retry[0][1])
+
+        return failed
+
+    def _delete(self, batch):
+        entries = [{'Id': str(i), 'ReceiptHandle': handle} for i, (handle, _) in enumerate(batch)]
+        self.calls += 1
+        start = time.perf_counter()
+
+        try:
+            response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            errors = {f['Id']: f for f in response.get('Failed', [])}
+
+        except ClientError as ce:
+            print(f'Fail to delete message batch: {ce}')
+            errors = {entry['Id']: {'Code': str(ce), 'SenderFault': False} for entry in entries}
+
+        except Exception as e:
+            print(f'Unexpected error when deleting message batch: {e}')
+            errors = {entry['Id']: {'Code': str(e), 'SenderFault': False} for entry in entries}
+
+        if self.observe:
+            self.observe(time.perf_counter() - start)
+
+        retry, dropped = [], []
+        for i, (handle, attempts) in enumerate(batch):
+            error = errors.get(str(i))
+            if error is None:
+                self.acked += 1
+            elif not error.get('SenderFault') and attempts + 1 < self.max_retries:
+                retry.append((handle, attempts + 1))
+            else:
+                print(f'Fail to delete message: {error.get("Code")} {error.get("Message", "")}')
+                self.failed += 1
+                dropped.append(handle)
+
+        return retry, dropped
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.pending), 'acked': self.acked,
+                    'failed': self.failed, 'calls': self.calls}
+
+### EOF
@@ -0,0 +1,154 @@
+# status_feed.py
+#
+# One shared change feed of job statuses for the web app: a single thread
+# polls every watched job with batch_get_item and wakes the requests
+# waiting on a job when its status changes
+##
+
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+'''
+reference:
+    1. batch get item: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/service-resource/batch_get_item.html
+    2. condition objects: https://docs.python.org/3/library/threading.html#condition-objects
+'''
+
+DYNAMO_MAX_KEYS = 100
+#statuses after which a job never changes again
+TERMINAL = ('COMPLETED', 'FAILED')
+
+
+class Watch:
+    def __init__(self, lock, status):
+        self.changed = threading.Condition(lock)
+        self.status = status
+        self.waiters = 0
+        self.idle_since = time.time()
+
+
+class StatusFeed:
+    '''
+    input:
+        dynamo: boto3 DynamoDB service resource
+        table_name: table holding the jobs
+        interval: seconds between polls while any job is watched
+        linger: keep polling a job this long after its last waiter left,
+                so a client reconnecting does not start cold
+        key: partition key of the table
+    '''
+    def __init__(self, dynamo, table_name, interval=2.0, linger=30, key='job_id'):
+        self.dynamo = dynamo
+        self.table_name = table_name
+        self.interval = interval
+        self.linger = linger
+        self.key = key
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        self.watches = {}
+        self.thread = None
+        self.polls = 0
+        self.reads = 0
+
+    def seed(self, job_id, status):
+        '''
+        Start watching a job from a status the caller has just read
+        '''
+        with self.lock:
+            watch = self.watches.get(job_id)
+            if watch is None:
+                watch = self.watches[job_id] = Watch(self.lock, status)
+            #the poll thread starts with the first watched job, not at import
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.work.notify()
+            return watch.status
+
+    def status(self, job_id):
+        with self.lock:
+            watch = self.watches.get(job_id)
+            return None if watch is None else watch.status
+
+    def wait(self, job_id, known, timeout):
+        '''
+        Block until the job's status differs from known or timeout passes
+        output:
+            status: the latest status seen by the feed
+        '''
+        deadline = time.time() + timeout
+        #a watch dropped between two waits of the same client comes back from known
+        self.seed(job_id, known)
+        with self.lock:
+            watch = self.watches[job_id]
+            watch.waiters += 1
+            try:
+                while watch.status == known and watch.status not in TERMINAL:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    watch.changed.wait(remaining)
+                return watch.status
+            finally:
+                watch.waiters -= 1
+                if not watch.waiters:
+                    watch.idle_since = time.time()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                for job_id, watch in list(self.watches.items()):
+                    if not watch.waiters and now - watch.idle_since >= self.linger:
+                        del self.watches[job_id]
+
+                while not self.watches:
+                    self.work.wait()
+
+                polled = [job_id for job_id, watch in self.watches.items() if watch.status not in TERMINAL]
+
+            if polled:
+                try:
+                    self.poll(polled)
+                except Exception as e:
+                    print(f'Fail to poll job statuses: {e}')
+            time.sleep(self.interval)
+
+    def poll(self, job_ids):
+        statuses = {}
+        for i in range(0, len(job_ids), DYNAMO_MAX_KEYS):
+            request = {self.table_name: {'Keys': [{self.key: job_id} for job_id in job_ids[i:i + DYNAMO_MAX_KEYS]],
+                                         'ProjectionExpression': f'{self.key}, job_status'}}
+            #unprocessed keys come back when the call is throttled; retry them
+            for attempt in range(5):
+                try:
+                    response = self.dynamo.batch_get_item(RequestItems=request)
+                except ClientError as ce:
+                    print(f'Fail to read job statuses: {ce}')
+                    break
+                self.reads += 1
+                for item in response['Responses'].get(self.table_name, []):
+                    statuses[item[self.key]] = item.get('job_status')
+
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+
+        with self.lock:
+            self.polls += 1
+            for job_id, status in statuses.items():
+                watch = self.watches.get(job_id)
+                if watch is not None and status != watch.status:
+                    watch.status = status
+                    watch.changed.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {'watched': len(self.watches),
+                    'waiters': sum(w.waiters for w in self.watches.values()),
+                    'polls': self.polls, 'reads': self.reads}
+
+### EOF
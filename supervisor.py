@@ -0,0 +1,179 @@
+# supervisor.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Owns every AnnTools child process started by the annotator
+##
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from subprocess import Popen
+
+'''
+reference:
+    1. wait4 and child resource usage: https://docs.python.org/3/library/os.html#os.wait4
+    2. resource.struct_rusage: https://docs.python.org/3/library/resource.html#resource.getrusage
+'''
+
+class Child:
+    '''
+    Handle for one supervised AnnTools run
+    '''
+    def __init__(self, job_id, process, start):
+        self.job_id = job_id
+        self.process = process
+        self.start = start
+        self.timed_out = False
+        self.record = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.record
+
+
+class AnnSupervisor:
+    '''
+    Starts AnnTools children under a concurrency cap, kills the ones that run
+    past the per-job timeout, reaps every exit and keeps wall time, CPU time
+    and peak RSS per job_id
+    input:
+        max_children: how many children may run at once
+        timeout: seconds before a child is terminated, 0 for no limit
+        grace: seconds between terminate and kill for a timed out child
+        history: how many finished job records to keep for queries
+    '''
+    def __init__(self, max_children, timeout=0, grace=10, history=1000):
+        self.slots = threading.BoundedSemaphore(max_children)
+        self.max_children = max_children
+        self.timeout = timeout
+        self.grace = grace
+        self.history = history
+        self.lock = threading.Lock()
+        self.running = {}
+        self.finished = OrderedDict()
+
+    def submit(self, args, job_id, on_exit=None):
+        '''
+        Start a child once a slot is free; blocks while the cap is reached
+        input:
+            args: command line for Popen
+            job_id: job the child belongs to
+            on_exit: optional callback called with the job record after reaping
+        output:
+            child: Child handle; errors from Popen are raised
+        '''
+        self.slots.acquire()
+        try:
+            process = Popen(args)
+
+        except Exception:
+            self.slots.release()
+            raise
+
+        child = Child(job_id, process, time.time())
+        with self.lock:
+            self.running[job_id] = child
+
+        threading.Thread(target=self._reap, args=(child, on_exit), daemon=True).start()
+        return child
+
+    def _reap(self, child, on_exit):
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self._expire, (child,))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            _, status, usage = os.wait4(child.process.pid, 0)
+            returncode = os.waitstatus_to_exitcode(status)
+
+        except ChildProcessError:
+            #already reaped elsewhere, usage is unknown
+            returncode, usage = child.process.returncode, None
+
+        finally:
+            if timer:
+                timer.cancel()
+
+        #let Popen know the child is gone so it does not try to reap it again
+        child.process.returncode = returncode
+
+        record = {'job_id': child.job_id,
+                  'pid': child.process.pid,
+                  'returncode': returncode,
+                  'timed_out': child.timed_out,
+                  'wall_time': round(time.time() - child.start, 3),
+                  'cpu_time': round(usage.ru_utime + usage.ru_stime, 3) if usage else None,
+                  'max_rss_kb': usage.ru_maxrss if usage else None}
+        child.record = record
+
+        with self.lock:
+            self.running.pop(child.job_id, None)
+
+        self.add_record(record)
+        self.slots.release()
+        child.done.set()
+
+        if on_exit:
+            try:
+                on_exit(record)
+            except Exception as e:
+                print(f'Unexpected error in exit callback for {child.job_id}: {e}')
+
+    def _expire(self, child):
+        if child.done.is_set():
+            return
+
+        print(f'anntools for {child.job_id} exceeded {self.timeout}s, terminating')
+        child.timed_out = True
+        try:
+            child.process.terminate()
+            if not child.done.wait(self.grace):
+                child.process.kill()
+
+        except ProcessLookupError:
+            pass
+
+    def add_record(self, record):
+        '''
+        Keep and log the resource record of a finished job; also used by the
+        warm pool so both engines are queried the same way
+        '''
+        with self.lock:
+            self.finished[record['job_id']] = record
+            while len(self.finished) > self.history:
+                self.finished.popitem(last=False)
+
+        print(json.dumps({'event': 'anntools_exit', **record}))
+
+    def free(self):
+        #children that could start right now without blocking
+        with self.lock:
+            return max(0, self.max_children - len(self.running))
+
+    def job_stats(self, job_id):
+        '''
+        Resource record for a finished job, or None while it is still running
+        '''
+        with self.lock:
+            return self.finished.get(job_id)
+
+    def summary(self):
+        with self.lock:
+            records = list(self.finished.values())
+            running = list(self.running)
+
+        return {'running': running,
+                'max_children': self.max_children,
+                'finished': len(records),
+                'timed_out': sum(1 for r in records if r['timed_out']),
+                'wall_time': round(sum(r['wall_time'] or 0 for r in records), 3),
+                'cpu_time': round(sum(r['cpu_time'] or 0 for r in records), 3),
+                'peak_rss_kb': max((r['max_rss_kb'] or 0 for r in records), default=0)}
+
+### EOF
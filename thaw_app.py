@@ -7,7 +7,7 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
-import boto3
+import aws_clients
 import json
 import requests
 import sys
@@ -16,6 +16,8 @@ import time
 from botocore.exceptions import ClientError
 from flask import Flask, request
 
+from archive_pack import aligned_range
+
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 
@@ -25,12 +27,13 @@ app.config.from_object(environment)
 REGION_NAME = app.config["AWS_REGION_NAME"]
 WAIT_TIME = int(app.config["WAIT_TIME"])
 MAX_MESSAGE = int(app.config["MAX_MESSAGE"])
-s3_client = boto3.client('s3', region_name = REGION_NAME)
-glacier_client = boto3.client('glacier', region_name = REGION_NAME)
-sns_client = boto3.client('sns', region_name = REGION_NAME)
-sqs_client = boto3.client('sqs', region_name = REGION_NAME)
-dynamo = boto3.resource('dynamodb', region_name=REGION_NAME)
-ann_table = dynamo.Table(app.config['TABLE_NAME'])
+#clients are created on first use, sized and retried per AWS_* settings in the config
+aws_clients.configure(**aws_clients.from_mapping(app.config))
+s3_client = aws_clients.LazyClient('s3')
+glacier_client = aws_clients.LazyClient('glacier')
+sns_client = aws_clients.LazyClient('sns')
+sqs_client = aws_clients.LazyClient('sqs')
+ann_table = aws_clients.table(app.config['TABLE_NAME'])
 EXPEDITED = app.config["TIER_EX"]
 STANDARD = app.config["TIER_ST"]
 
@@ -46,6 +49,7 @@ reference:
     2. initiate archive retrival: https://docs.aws.amazon.com/amazonglacier/latest/dev/example_glacier_InitiateJob_ArchiveRetrieval_section.html
     3. describe job: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/describe_job.html
     4. provisioned capability for glaicer retrival: https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html#api-downloading-an-archive-two-steps-retrieval-expedited-capacity
+    5. range retrieval: https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html#downloading-an-archive-range
 '''
 @app.route("/thaw", methods=["POST"])
 def thaw_premium_user_data():
@@ -98,13 +102,14 @@ def send_thaw_request(message):
         print('no files to retrieve')
         return 'no files to retrieve'
 
-    for archive_id, job_id in arc_lst:
+    #one retrieval per archive, however many of the user's results it packs
+    for archive_id, job_ids, byte_range in arc_lst:
         print('sending request...')
-        print(job_id, archive_id)
+        print(job_ids, archive_id, byte_range)
 
         #try expedited
         try:
-            arc_job_id = glacier_retrival(archive_id, user_id, tier = EXPEDITED)
+            arc_job_id = glacier_retrival(archive_id, user_id, tier = EXPEDITED, byte_range = byte_range)
             print('Expedited request sent')
 
         except ClientError as ce:
@@ -114,7 +119,7 @@ def send_thaw_request(message):
                 print('Expedited retrival failed: now trying standard retrival')
 
                 try:
-                    arc_job_id = glacier_retrival(archive_id, user_id, tier = STANDARD)
+                    arc_job_id = glacier_retrival(archive_id, user_id, tier = STANDARD, byte_range = byte_range)
                     print('Standard request sent')
 
                 except ClientError as ce:
@@ -130,7 +135,8 @@ def send_thaw_request(message):
                     jobId=arc_job_id)
                 
                 # status_check(response)
-                update_request_sent(job_id)
+                for job_id in job_ids:
+                    update_request_sent(job_id)
                 continue
         
                 
@@ -145,7 +151,8 @@ def send_thaw_request(message):
                     jobId=arc_job_id)
         
         # status_check(response) 
-        update_request_sent(job_id)
+        for job_id in job_ids:
+            update_request_sent(job_id)
 
         
     return 'All request finished'       
@@ -155,32 +162,57 @@ def status_check(response):
         print('status check',response['StatusCode'])
         time.sleep(60)
 
-def glacier_retrival(archive_id, user_id, tier):
+def glacier_retrival(archive_id, user_id, tier, byte_range=None):
+    #the restore lambda restores every result of the user's held in the retrieved range
+    params = {'Type': 'archive-retrieval',
+              'ArchiveId': archive_id,
+              'Description': user_id,
+              'Tier': tier,
+              'SNSTopic': app.config['AWS_SNS_JOB_RESTORE_TOPIC']}
+    #a pack is fetched with a megabyte-aligned range retrieval spanning the results to thaw
+    if byte_range:
+        params['RetrievalByteRange'] = byte_range
+
     retrival_job = glacier_client.initiate_job(
                                 vaultName=app.config['AWS_GLACIER_VAULT'],
-                                jobParameters={'Type': 'archive-retrieval',
-                                                'ArchiveId': archive_id,
-                                                'Description': user_id,
-                                                'Tier': tier,
-                                                'SNSTopic': app.config['AWS_SNS_JOB_RESTORE_TOPIC']})
+                                jobParameters=params)
     job_id = retrival_job['jobId']
 
     return job_id
 
 def get_arc_ids(user_id):
-    response = ann_table.query(
-            IndexName = 'user_id_index', 
-            ProjectionExpression = 'results_file_archive_id, retrival_request_sent, job_id',
-            KeyConditionExpression = 'user_id = :user',
-            ExpressionAttributeValues = {':user': user_id})
-    
+    '''
+    output:
+        [(archive_id, job_ids, byte_range)], one per archive still to thaw;
+        byte_range spans every listed result in a pack, None for a whole archive
+    '''
+    kwargs = {'IndexName': 'user_id_index',
+              'ProjectionExpression': 'results_file_archive_id, retrival_request_sent, job_id, '
+                                      'archive_offset, archive_length, archive_size',
+              'KeyConditionExpression': 'user_id = :user',
+              'ExpressionAttributeValues': {':user': user_id}}
+
+    archives = {}
+    while True:
+        response = ann_table.query(**kwargs)
+        for job in response['Items']:
+            arc_id = job.get('results_file_archive_id')
+            req_sent = job.get('retrival_request_sent')
+            if arc_id and not req_sent: #send request only when the request is not sent and archive id still exist
+                archives.setdefault(arc_id, []).append(job)
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
     arc_lst = []
-    for job in response['Items']:
-        arc_id = job.get('results_file_archive_id')
-        req_sent = job.get('retrival_request_sent')
-        job_id = job.get('job_id')
-        if arc_id and not req_sent: #send request only when the request is not sent and archive id still exist
-            arc_lst.append((arc_id, job_id))
+    for arc_id, jobs in archives.items():
+        byte_range = None
+        packed = [job for job in jobs if job.get('archive_offset') is not None]
+        if packed:
+            start = min(int(job['archive_offset']) for job in packed)
+            end = max(int(job['archive_offset']) + int(job['archive_length']) for job in packed)
+            byte_range = aligned_range(start, end - start, int(packed[0]['archive_size']))
+        arc_lst.append((arc_id, [job['job_id'] for job in jobs], byte_range))
 
     return arc_lst
 
@@ -0,0 +1,159 @@
+# tier_cache.py
+#
+# User tiers (free_user / premium_user) from the accounts database, cached
+# with a bounded TTL. Lookups that miss at about the same time are resolved
+# together with one batched query, and a role change drops the user's entry
+##
+
+import threading
+import time
+
+from ttl_cache import TTLCache
+
+'''
+reference:
+    1. psycopg2 ANY with a list: https://www.psycopg.org/docs/usage.html#lists-adaptation
+    2. sns http subscription: https://docs.aws.amazon.com/sns/latest/dg/SendMessageToHttp.prepare.html
+'''
+
+def accounts_roles(dsn):
+    '''
+    Batched lookup against the accounts database's profiles table
+    input:
+        dsn: connection string of the accounts database
+    output:
+        lookup(user_ids) -> {user_id: role}
+    '''
+    def lookup(user_ids):
+        #only the apps that use it need psycopg2
+        import psycopg2
+        conn = psycopg2.connect(dsn)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT identity_id, role FROM profiles WHERE identity_id = ANY(%s)',
+                               (list(user_ids),))
+                return dict(cursor.fetchall())
+        finally:
+            conn.close()
+    return lookup
+
+def one_by_one(get_profile, index=4):
+    '''
+    Fallback lookup with one get_user_profile call per user
+    '''
+    def lookup(user_ids):
+        return {user_id: get_profile(user_id)[index] for user_id in user_ids}
+    return lookup
+
+
+class Batch:
+    def __init__(self):
+        self.users = set()
+        self.done = threading.Event()
+        self.tiers = {}
+        self.error = None
+        #users invalidated while the query ran; their answer may predate the change
+        self.stale = set()
+
+
+class TierCache:
+    '''
+    input:
+        lookup: called with a list of user ids, returns {user_id: tier};
+                users it leaves out are looked up again next time
+        ttl: seconds a tier is trusted without an invalidation
+        maxsize: most users kept
+        max_wait: seconds the first miss waits for others to join its query
+        max_batch: most users per query
+    '''
+    def __init__(self, lookup, ttl=300, maxsize=65536, max_wait=0.01, max_batch=100):
+        self.lookup = lookup
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        #batch still taking users, if any, and batches being queried
+        self.open = None
+        self.running = set()
+        self.queries = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        '''
+        output:
+            tier of the user, or None if the accounts database has no profile;
+            errors of the lookup are raised
+        '''
+        return self.get_many([user_id]).get(user_id)
+
+    def get_many(self, user_ids):
+        '''
+        output:
+            {user_id: tier} for every user the accounts database knows
+        '''
+        found, missing = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            tier = self.cache.get(user_id)
+            if tier is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = tier
+
+        if missing:
+            found.update(self.resolve(missing))
+        return found
+
+    def resolve(self, user_ids):
+        with self.lock:
+            leader = self.open is None
+            if leader:
+                self.open = Batch()
+            batch = self.open
+            batch.users.update(user_ids)
+
+        if leader:
+            self.run(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return {user_id: batch.tiers[user_id] for user_id in user_ids if user_id in batch.tiers}
+
+    def run(self, batch):
+        #let concurrent misses join this query, then close it to newcomers
+        if self.max_wait:
+            time.sleep(self.max_wait)
+        with self.lock:
+            self.open = None
+            self.running.add(batch)
+            users = list(batch.users)
+
+        try:
+            for i in range(0, len(users), self.max_batch):
+                self.queries += 1
+                batch.tiers.update(self.lookup(users[i:i + self.max_batch]))
+            with self.lock:
+                for user_id, tier in batch.tiers.items():
+                    if user_id not in batch.stale:
+                        self.cache.set(user_id, tier)
+
+        except Exception as e:
+            batch.error = e
+
+        finally:
+            with self.lock:
+                self.running.discard(batch)
+            batch.done.set()
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.invalidations += 1
+            for batch in self.running:
+                batch.stale.add(user_id)
+        return self.cache.pop(user_id)
+
+    def stats(self):
+        return dict(self.cache.stats(), queries=self.queries, invalidations=self.invalidations)
+
+### EOF
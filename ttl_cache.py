@@ -0,0 +1,74 @@
+# ttl_cache.py
+#
+# Small bounded, thread-safe TTL cache shared by the web app and the
+# utility apps
+##
+
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+class TTLCache:
+    '''
+    LRU-bounded cache whose entries expire after ttl seconds
+    input:
+        maxsize: most entries kept; the least recently used go first
+        ttl: default lifetime of an entry in seconds
+    '''
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not MISSING:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, MISSING)
+        return None if entry is MISSING else entry[1]
+
+    def invalidate(self, owner):
+        '''
+        Drop the entry keyed by owner and every tuple key starting with it,
+        e.g. all cached pages of one user
+        '''
+        with self.lock:
+            stale = [k for k in self.entries
+                     if k == owner or (isinstance(k, tuple) and k and k[0] == owner)]
+            for key in stale:
+                del self.entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+### EOF
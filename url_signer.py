@@ -0,0 +1,46 @@
+# url_signer.py
+#
+# Presigned S3 GET URLs, cached per (bucket, key) until shortly before
+# they expire
+##
+
+from ttl_cache import TTLCache
+
+'''
+reference:
+    1. generate presigned url: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/generate_presigned_url.html
+'''
+
+class UrlSigner:
+    '''
+    input:
+        s3: boto3 S3 client (s3v4 signatures)
+        expires_in: lifetime of a signed URL in seconds
+        margin: a cached URL is re-signed once it has less than this left
+                (at most half its lifetime)
+        maxsize: most URLs kept
+    '''
+    def __init__(self, s3, expires_in, margin=60, maxsize=4096):
+        self.s3 = s3
+        self.expires_in = expires_in
+        self.cache = TTLCache(maxsize=maxsize, ttl=expires_in - min(margin, expires_in // 2))
+
+    def sign(self, bucket, key):
+        url = self.cache.get((bucket, key))
+        if url is None:
+            url = self.s3.generate_presigned_url('get_object',
+                                                 Params={'Bucket': bucket, 'Key': key},
+                                                 ExpiresIn=self.expires_in)
+            self.cache.set((bucket, key), url)
+        return url
+
+    def sign_many(self, objects):
+        '''
+        Sign every (bucket, key) of a page in one pass; signing is local, so
+        this costs one cache lookup per object plus one HMAC per miss
+        output:
+            urls: {(bucket, key): url}
+        '''
+        return {obj: self.sign(*obj) for obj in dict.fromkeys(objects)}
+
+### EOF
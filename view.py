@@ -9,16 +9,19 @@
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import uuid
+import hmac
+import hashlib
 import time
 import json
+import base64
+from decimal import Decimal
 from datetime import datetime, timedelta
 
-import boto3
-from botocore.client import Config
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
-from flask import abort, flash, redirect, render_template, request, session, url_for
+from flask import (abort, flash, g, jsonify, redirect, render_template, request, session, url_for,
+                   Response, stream_with_context)
 
 from app import app, db
 from decorators import authenticated, is_premium
@@ -26,14 +29,112 @@ import sys
 
 REGION_NAME = app.config["AWS_REGION_NAME"]
 TABLE_NAME = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-dynamo = boto3.resource('dynamodb', region_name=REGION_NAME)
-ann_table = dynamo.Table(TABLE_NAME)
-sns = boto3.client('sns', region_name = REGION_NAME)
-s3 = boto3.client( "s3",
-        region_name= REGION_NAME,
-        config=Config(signature_version="s3v4"))
+#clients are created on first use, sized and retried per AWS_* settings in the config
+import aws_clients
+aws_clients.configure(**aws_clients.from_mapping(app.config))
+dynamo = aws_clients.LazyResource('dynamodb')
+ann_table = aws_clients.table(TABLE_NAME)
+sns = aws_clients.LazyClient('sns')
+s3 = aws_clients.LazyClient('s3', signature_version="s3v4")
+
+from auth import update_profile as auth_update_profile, get_profile
+from ttl_cache import TTLCache
+from url_signer import UrlSigner
+from sns_outbox import Outbox
+from status_feed import StatusFeed, TERMINAL
+from log_stream import gzip_chunks, iter_body, object_size, open_range, page_range, read_page
+
+#pages of a user's annotation list, keyed by (user_id, cursor, page size, order);
+#dropped when that user submits a job
+annotations_cache = TTLCache(maxsize=app.config.get('ANNOTATIONS_CACHE_SIZE', 1024),
+                             ttl=app.config.get('ANNOTATIONS_CACHE_TTL', 10))
+PAGE_SIZE = app.config.get('ANNOTATIONS_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = 500
+
+#presigned download links, reused until shortly before they expire
+signer = UrlSigner(s3, app.config['AWS_SIGNED_REQUEST_EXPIRATION'],
+                   margin=app.config.get('SIGNED_URL_REFRESH_MARGIN', 60))
+
+#job requests are written with a dispatch marker and published to SNS in batches
+outbox = Outbox(sns, app.config['AWS_SNS_JOB_REQUEST_TOPIC'], ann_table,
+                max_wait=app.config.get('OUTBOX_MAX_WAIT', 0.05),
+                sweep_interval=app.config.get('OUTBOX_SWEEP_INTERVAL', 60),
+                sweep_age=app.config.get('OUTBOX_SWEEP_AGE', 120),
+                index=app.config.get('AWS_DYNAMODB_OUTBOX_INDEX'))
+
+#job statuses for the long-poll and event-stream endpoints, polled by one thread
+status_feed = StatusFeed(dynamo, TABLE_NAME, interval=app.config.get('STATUS_POLL_INTERVAL', 2),
+                         linger=app.config.get('STATUS_WATCH_LINGER', 30))
+STATUS_LONG_POLL_MAX = app.config.get('STATUS_LONG_POLL_MAX', 25)
+STATUS_STREAM_MAX = app.config.get('STATUS_STREAM_MAX', 300)
+STATUS_HEARTBEAT = app.config.get('STATUS_HEARTBEAT', 15)
+#a job's owner never changes
+owner_cache = TTLCache(maxsize=app.config.get('STATUS_OWNER_CACHE_SIZE', 65536), ttl=3600)
+
+#most files in one bulk submission
+BULK_MAX_FILES = app.config.get('BULK_MAX_FILES', 500)
+
+#a log page asked for with ?offset=, ?tail= or ?limit= is read with an S3 byte
+#range of LOG_PAGE_KB by default and at most LOG_MAX_PAGE_KB; without them the
+#page is the whole log
+LOG_PAGE_KB = app.config.get('LOG_PAGE_KB', 256)
+LOG_MAX_PAGE_KB = app.config.get('LOG_MAX_PAGE_KB', 4096)
+LOG_GZIP = app.config.get('LOG_GZIP', True)
+
+#user roles from the accounts database, dropped whenever update_profile changes one
+role_cache = TTLCache(maxsize=app.config.get('PROFILE_CACHE_SIZE', 4096),
+                      ttl=app.config.get('PROFILE_CACHE_TTL', 60))
+
+#everything the detail and log pages read from a job, fetched in one get_item
+JOB_PROJECTION = ('job_id, submit_time, input_file_name, job_status, user_id, complete_time, '
+                  's3_key_input_file, s3_key_result_file, s3_key_log_file, '
+                  'results_file_archive_id, s3_results_bucket')
 
-from auth import update_profile, get_profile
+'''
+reference:
+    1. flask g: https://flask.palletsprojects.com/en/2.3.x/appcontext/#storing-data
+    2. get_item: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/get_item.html
+'''
+
+def get_job(job_id):
+    '''
+    One projected read per job per request, shared by every helper that
+    needs it; returns a copy the caller may modify, or None
+    '''
+    jobs = g.setdefault('jobs', {})
+    if job_id not in jobs:
+        response = ann_table.get_item(Key={'job_id': job_id}, ProjectionExpression=JOB_PROJECTION)
+        jobs[job_id] = response.get('Item')
+
+    job = jobs[job_id]
+    return dict(job) if job else None
+
+def get_user_role(user_id):
+    role = role_cache.get(user_id)
+    if role is None:
+        role = get_profile(identity_id = user_id).role
+        role_cache.set(user_id, role)
+    return role
+
+def update_profile(**kwargs):
+    # Every role change in this app goes through here, so cached roles never outlive it
+    auth_update_profile(**kwargs)
+    role_cache.pop(kwargs.get('identity_id'))
+    publish_role_change(kwargs.get('identity_id'), kwargs.get('role'))
+
+def publish_role_change(user_id, role):
+    #the archive app caches tiers too; it drops the user's on this message
+    topic = app.config.get('AWS_SNS_ROLE_CHANGE_TOPIC')
+    if not topic or role is None:
+        return
+    try:
+        sns.publish(TopicArn = topic, Message = json.dumps({'user_id': user_id, 'role': role}))
+
+    except ClientError as ce:
+        app.logger.exception(f"Error publishing role change of '{user_id}': {ce}")
+
+    except Exception as e:
+        app.logger.exception(f"Error publishing role change of '{user_id}': {e}")
 
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
@@ -93,7 +194,7 @@ def annotate():
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
-publishes a notification for the annotator service.
+queues a notification for the annotator service in the outbox.
 """
 
 
@@ -120,9 +221,9 @@ def create_annotation_job_request():
               "submit_time": int(time.time()),
               "job_status": "PENDING"
             }
-    #upload to DynamoDB
+    #one write on the request path; the outbox publishes the job to SNS in the background
     try:
-        ann_table.put_item(Item = data)
+        outbox.submit(data)
 
     except ClientError as ce:
         app.logger.exception(f"Error putting item to dynamoDB: '{job_id}'")
@@ -132,22 +233,137 @@ def create_annotation_job_request():
         app.logger.exception(f"Error putting item to dynamoDB: '{job_id}'")
         return abort(500)
 
-    # Send message to request queue
+    annotations_cache.invalidate(user_id)
+
+    return render_template("annotate_confirm.html", job_id=job_id)
+
+
+"""Bulk submission of a cohort
+POST /annotate/bulk with {"files": [names]} returns a cohort id and one
+presigned POST per file; once the uploads are done, POST
+/annotate/bulk/<cohort_id>/jobs with {"jobs": [{"job_id", "key"}]} registers
+every job in one batch write and queues them for batched publishing
+"""
+'''
+reference:
+    1. presigned post: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/generate_presigned_post.html
+    2. success_action_status: https://docs.aws.amazon.com/AmazonS3/latest/API/RESTObjectPOST.html
+'''
+
+@app.route("/annotate/bulk", methods=["POST"])
+@authenticated
+def annotate_bulk():
+    user_id = session.get('primary_identity')
+    body = request.get_json(silent=True) or {}
+    files = body.get('files') if isinstance(body, dict) else None
+
+    if not files or not isinstance(files, list) or len(files) > BULK_MAX_FILES:
+        return abort(400)
+    # '/' and '~' separate the parts of an input key
+    if not all(isinstance(f, str) and f and '/' not in f and '~' not in f for f in files):
+        return abort(400)
+
+    cohort_id = str(uuid.uuid4())
+    bucket_name = app.config["AWS_S3_INPUTS_BUCKET"]
+    encryption = app.config["AWS_S3_ENCRYPTION"]
+    acl = app.config["AWS_S3_ACL"]
+    fields = {"success_action_status": "201",
+              "x-amz-server-side-encryption": encryption,
+              "acl": acl}
+    conditions = [{"success_action_status": "201"},
+                  {"x-amz-server-side-encryption": encryption},
+                  {"acl": acl}]
+
+    uploads = []
+    try:
+        # Signing is local, so N posts cost no round trips
+        for index, file_name in enumerate(files):
+            job_id = bulk_job_id(user_id, cohort_id, index)
+            key_name = app.config["AWS_S3_KEY_PREFIX"] + user_id + "/" + job_id + "~" + file_name
+            uploads.append({"job_id": job_id, "file_name": file_name, "key": key_name,
+                            "s3_post": s3.generate_presigned_post(
+                                Bucket=bucket_name,
+                                Key=key_name,
+                                Fields=fields,
+                                Conditions=conditions,
+                                ExpiresIn=app.config["AWS_SIGNED_REQUEST_EXPIRATION"])})
+
+    except ClientError as e:
+        app.logger.error(f"Unable to generate presigned URLs for upload: {e}")
+        return abort(500)
+
+    return jsonify(cohort_id=cohort_id, bucket=bucket_name, uploads=uploads)
+
+
+def bulk_job_id(user_id, cohort_id, index):
+    '''
+    Job id issued for the index-th file of a cohort: a UUID made from an HMAC
+    of the cohort, so registration can check an id without storing it
+    '''
+    digest = hmac.new(app.config['SECRET_KEY'].encode(), f'{user_id}/{cohort_id}/{index}'.encode(),
+                      hashlib.sha256).digest()
+    return str(uuid.UUID(bytes=digest[:16], version=4))
+
+@app.route("/annotate/bulk/<cohort_id>/jobs", methods=["POST"])
+@authenticated
+def create_bulk_annotation_jobs(cohort_id):
+    user_id = session.get('primary_identity')
+    body = request.get_json(silent=True) or {}
+    jobs = body.get('jobs') if isinstance(body, dict) else None
+
+    try:
+        uuid.UUID(cohort_id)
+    except ValueError:
+        return abort(400)
+    if not jobs or not isinstance(jobs, list) or len(jobs) > BULK_MAX_FILES:
+        return abort(400)
+
+    prefix = app.config["AWS_S3_KEY_PREFIX"] + user_id + "/"
+    # Only ids issued to this user for this cohort; anything else could name an existing job
+    issued = {bulk_job_id(user_id, cohort_id, index) for index in range(BULK_MAX_FILES)}
+    submit_time = int(time.time())
+    items = []
+    for job in jobs:
+        key = job.get('key') if isinstance(job, dict) else None
+        # Only keys issued to this user, in the same form as a single upload
+        if not isinstance(key, str) or not key.startswith(prefix) or key.count('/') != prefix.count('/'):
+            return abort(400)
+        job_id, _, file_name = key[len(prefix):].partition('~')
+        if not file_name or job.get('job_id', job_id) != job_id or job_id not in issued:
+            return abort(400)
+
+        items.append({"job_id": job_id,
+                      "user_id": user_id,
+                      "input_file_name": file_name,
+                      "s3_inputs_bucket": app.config["AWS_S3_INPUTS_BUCKET"],
+                      "s3_key_input_file": key,
+                      "submit_time": submit_time,
+                      "job_status": "PENDING",
+                      "cohort_id": cohort_id})
+
+    job_ids = [item['job_id'] for item in items]
+    if len(set(job_ids)) != len(job_ids):
+        return abort(400)
+
     try:
-        print(app.config['AWS_SNS_JOB_REQUEST_TOPIC'])
-        response = sns.publish(TopicArn = app.config['AWS_SNS_JOB_REQUEST_TOPIC'], 
-                Message = json.dumps(data))
-        print('message sent to request')
+        # Conditional puts never overwrite a job, so a retried registration only adds the missing ones
+        existing = outbox.submit_many(items)
 
     except ClientError as ce:
-        app.logger.exception(f"Error publishing job to sns: '{job_id}'")
+        app.logger.exception(f"Error putting cohort to dynamoDB: '{cohort_id}'")
         return abort(500)
-        
+
     except Exception as e:
-        app.logger.exception(f"Error publishing job to sns: '{job_id}'")
+        app.logger.exception(f"Error putting cohort to dynamoDB: '{cohort_id}'")
         return abort(500)
 
-    return render_template("annotate_confirm.html", job_id=job_id)
+    already = set(existing)
+    created = [job_id for job_id in job_ids if job_id not in already]
+    if created:
+        annotations_cache.invalidate(user_id)
+
+    return jsonify(cohort_id=cohort_id, job_ids=job_ids, created=created, existing=existing), \
+        201 if created else 200
 
 
 """List all annotations for the user
@@ -167,31 +383,131 @@ reference:
 def annotations_list():
 
     user_id = session.get('primary_identity')
-    # Get list of annotations to display
+    if not user_id: #unauthenticated
+        return abort(403)
+
+    # Without ?cursor= or ?page_size= the whole list is shown; with them one page is,
+    # and ?cursor= continues where the last page stopped
+    paged = 'cursor' in request.args or 'page_size' in request.args
+    cursor = request.args.get('cursor')
+    order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+    try:
+        page_size = min(MAX_PAGE_SIZE, max(1, int(request.args.get('page_size', PAGE_SIZE))))
+    except ValueError:
+        return abort(400)
+
+    # ?cohort= keeps only the jobs of one bulk submission
+    cohort = request.args.get('cohort')
+
+    page_key = (user_id, paged, cursor, page_size, order, cohort)
+    page = annotations_cache.get(page_key)
+
+    if page is None:
+        kwargs = {'IndexName': 'user_id_index',
+                  'ProjectionExpression': 'job_id, submit_time, input_file_name, job_status, user_id, '
+                                          's3_key_input_file, s3_key_result_file, results_file_archive_id, '
+                                          'cohort_id',
+                  'KeyConditionExpression': 'user_id = :user',
+                  'ExpressionAttributeValues': {':user': user_id},
+                  'ScanIndexForward': order == 'asc'}
+        if paged:
+            kwargs['Limit'] = page_size
+
+        if cohort:
+            #applied after Limit, so a filtered page may hold fewer items; the cursor still continues it
+            kwargs['FilterExpression'] = 'cohort_id = :cohort'
+            kwargs['ExpressionAttributeValues'][':cohort'] = cohort
+
+        if cursor:
+            start_key = decode_cursor(cursor)
+            if not isinstance(start_key, dict) or start_key.get('user_id') != user_id:
+                return abort(400)
+            kwargs['ExclusiveStartKey'] = start_key
+
+        try:
+            response = ann_table.query(**kwargs)
+            items = response['Items']
+            # The whole list follows the query through every page
+            while not paged and 'LastEvaluatedKey' in response:
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+                response = ann_table.query(**kwargs)
+                items.extend(response['Items'])
+
+        except ClientError as ce:
+            app.logger.error(f'Unable to draw annotations: {ce}')
+            return abort(500)
+
+        except Exception as e:
+            app.logger.error(f'Unexpected error when drawing annotations:{e}')
+            return abort(500)
+
+        # Pages come in order from user_id_index's submit_time sort key through
+        # ScanIndexForward; the whole list is sorted here, so it needs no sort key
+        if not paged:
+            items.sort(key=lambda item: item['submit_time'], reverse=order == 'desc')
+
+        # Converted once per cached page rather than on every view
+        for item in items:
+            item['submit_time'] = change_time_to_CST(item['submit_time'])
+
+        page = {'items': items,
+                'next_cursor': encode_cursor(response.get('LastEvaluatedKey')) if paged else None}
+        annotations_cache.set(page_key, page)
+
     try:
-        response = ann_table.query(
-            IndexName = 'user_id_index', 
-            ProjectionExpression = 'job_id, submit_time, input_file_name, job_status, user_id',
-            KeyConditionExpression = 'user_id = :user',
-            ExpressionAttributeValues = {':user': user_id})
+        annotations = add_download_links(page['items'])
 
     except ClientError as ce:
-        app.logger.error(f'Unable to draw annotations: {ce}')
-        if not user_id: #unauthenticated
-            return abort(403)
-        
+        app.logger.error(f'Unable to sign download links: {ce}')
         return abort(500)
 
-    except Exception as e:
-        app.logger.error(f'Unexpected error when drawing annotations:{e}')
-        return abort(500)
+    url = request.url
 
-    for item in response['Items']:
-        item['submit_time'] = change_time_to_CST(item['submit_time'])
+    return render_template("annotations.html", annotations=annotations, url = url,
+                           next_cursor = page['next_cursor'], page_size = page_size, order = order,
+                           cohort = cohort)
 
-    url = request.url
+'''
+reference:
+    1. query pagination: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
+'''
+
+def add_download_links(items):
+    '''
+    Copies of the (cached) page items with input_url, and result_url for
+    results still in S3, signed in one pass
+    '''
+    inputs, results = app.config["AWS_S3_INPUTS_BUCKET"], app.config["AWS_S3_RESULTS_BUCKET"]
+    objects = []
+    for item in items:
+        objects.append((inputs, item.get('s3_key_input_file')))
+        if item.get('job_status') == 'COMPLETED' and not item.get('results_file_archive_id'):
+            objects.append((results, item.get('s3_key_result_file')))
+
+    urls = signer.sign_many(obj for obj in objects if obj[1])
+
+    annotations = []
+    for item in items:
+        item = dict(item)
+        item['input_url'] = urls.get((inputs, item.get('s3_key_input_file')))
+        item['result_url'] = urls.get((results, item.get('s3_key_result_file')))
+        annotations.append(item)
+    return annotations
+
+def encode_cursor(last_key):
+    #opaque, url-safe form of LastEvaluatedKey; numbers come back from DynamoDB as Decimal
+    if not last_key:
+        return None
+    raw = json.dumps(last_key, default=lambda d: {'__decimal__': str(d)})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        return json.loads(raw, object_hook=lambda o: Decimal(o['__decimal__']) if '__decimal__' in o else o)
 
-    return render_template("annotations.html", annotations=response['Items'], url = url)
+    except (ValueError, TypeError):
+        return None
 
 
 """Display details of a specific annotation job
@@ -208,19 +524,8 @@ def annotation_details(id):
     
     res_url, status = None, None
 
-    #check whether a job id exist
-    response = ann_table.get_item(Key={'job_id': id})
-
-    if 'Item' not in response:
-        return abort(404)
-
     try:
-        response = ann_table.query(
-            ProjectionExpression = 'job_id, submit_time, input_file_name, job_status, user_id,\
-                                    complete_time, s3_key_input_file, s3_key_result_file, \
-                                    s3_key_log_file, results_file_archive_id, s3_results_bucket',
-            KeyConditionExpression = 'job_id = :id',
-            ExpressionAttributeValues = {':id': id})
+        job = get_job(id)
 
     except ClientError as ce:
         app.logger.exception(f'error when finding job detail: {id}')
@@ -234,13 +539,17 @@ def annotation_details(id):
         app.logger.exception(f'error when finding job detail: {id}')
         return abort(500)
 
-    job = response['Items'][0]
+    #check whether a job id exist
+    if job is None:
+        return abort(404)
+
     job_id = job['job_id']
     user_id = session.get('primary_identity')
-    user_type = get_profile(identity_id = user_id).role
 
     if session.get('primary_identity') != job['user_id']:
         return abort(403)
+
+    user_type = get_user_role(user_id)
     
     job['submit_time'] = change_time_to_CST(job['submit_time'])
 
@@ -256,9 +565,7 @@ def annotation_details(id):
         
         #url to download res
         try:
-            res_url = s3.generate_presigned_url('get_object',
-                                          Params={'Bucket': app.config["AWS_S3_RESULTS_BUCKET"], 'Key': job['s3_key_result_file']},
-                                                    ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'] )
+            res_url = signer.sign(app.config["AWS_S3_RESULTS_BUCKET"], job['s3_key_result_file'])
         except ClientError as ce:
             app.logger.exception(f'error when generating presigned url for result file: {id}')
             return abort(500)
@@ -271,9 +578,7 @@ def annotation_details(id):
 
     #url to download input file
     try:
-        input_url = s3.generate_presigned_url('get_object',
-                                          Params={'Bucket': app.config["AWS_S3_INPUTS_BUCKET"], 'Key': job['s3_key_input_file']},
-                                                    ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'] )
+        input_url = signer.sign(app.config["AWS_S3_INPUTS_BUCKET"], job['s3_key_input_file'])
     except ClientError as ce:
         app.logger.exception(f'error when generating presigned url for result file: {id}')
         return abort(500)
@@ -286,11 +591,94 @@ def annotation_details(id):
     return render_template("annotation.html", job=job, input_url = input_url, 
                            res_url = res_url, status = status)
 
+"""Push job status changes to the browser
+/annotations/<id>/status is a long poll: it answers as soon as the status
+differs from ?known= or after ?timeout= seconds. /annotations/<id>/events
+streams every change as server-sent events. Both wait on one shared
+status feed, so open tabs add no DynamoDB reads of their own
+"""
+'''
+reference:
+    1. server-sent events: https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events
+    2. long polling: https://javascript.info/long-polling
+'''
+
+def watch_job(id):
+    '''
+    Owner and current status of a job for the status endpoints; the table is
+    read only when the owner is not cached or the feed is not watching the job
+    '''
+    owner, status = owner_cache.get(id), status_feed.status(id)
+    if owner is None or status is None:
+        job = get_job(id)
+        if job is None:
+            return None, None
+        owner, status = job['user_id'], job['job_status']
+        owner_cache.set(id, owner)
+    return owner, status_feed.seed(id, status)
+
+@app.route("/annotations/<id>/status", methods=["GET"])
+@authenticated
+def annotation_status(id):
+    try:
+        owner, status = watch_job(id)
+        timeout = min(STATUS_LONG_POLL_MAX, max(0, float(request.args.get('timeout', STATUS_LONG_POLL_MAX))))
+
+    except ValueError:
+        return abort(400)
+
+    except ClientError as ce:
+        app.logger.exception(f'error when finding job status: {id}')
+        return abort(500)
+
+    if owner is None:
+        return abort(404)
+    if session.get('primary_identity') != owner:
+        return abort(403)
+
+    known = request.args.get('known')
+    if known == status:
+        status = status_feed.wait(id, known, timeout)
+
+    return jsonify(job_id=id, job_status=status, changed=status != known)
+
+@app.route("/annotations/<id>/events", methods=["GET"])
+@authenticated
+def annotation_events(id):
+    try:
+        owner, status = watch_job(id)
+
+    except ClientError as ce:
+        app.logger.exception(f'error when finding job status: {id}')
+        return abort(500)
+
+    if owner is None:
+        return abort(404)
+    if session.get('primary_identity') != owner:
+        return abort(403)
+
+    def events(status):
+        # Current status first, then every change, with a comment line as
+        # heartbeat; the browser's EventSource reconnects after the stream ends
+        deadline = time.time() + STATUS_STREAM_MAX
+        yield f'event: status\ndata: {json.dumps({"job_id": id, "job_status": status})}\n\n'
+        while status not in TERMINAL and time.time() < deadline:
+            latest = status_feed.wait(id, status, min(STATUS_HEARTBEAT, max(0, deadline - time.time())))
+            if latest == status:
+                yield ': keep-alive\n\n'
+                continue
+            status = latest
+            yield f'event: status\ndata: {json.dumps({"job_id": id, "job_status": status})}\n\n'
+
+    return Response(events(status), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 """Display the log file contents for an annotation job
 """
 '''
 reference: 
     1. read s3 file: https://stackoverflow.com/questions/36205481/read-file-content-from-s3-bucket-with-boto3
+    2. streaming contents: https://flask.palletsprojects.com/en/2.3.x/patterns/streaming/
 '''
 
 @app.route("/annotations/<id>/log", methods=["GET"])
@@ -298,10 +686,7 @@ reference:
 def annotation_log(id):
 
     try:
-        response = ann_table.query(
-            ProjectionExpression = 'job_id, s3_key_log_file, user_id',
-            KeyConditionExpression = 'job_id = :id',
-            ExpressionAttributeValues = {':id': id})
+        job = get_job(id)
 
     except ClientError as ce:
         app.logger.error(f'{ce}')
@@ -313,21 +698,45 @@ def annotation_log(id):
         app.logger.error(f'{e}')
         return abort(500)
 
-    job = response['Items'][0]
+    if job is None:
+        return abort(404)
 
     #wrong user
     if session.get('primary_identity') != job['user_id']:
         return abort(403)
     
-    try:
-        response = s3.get_object(Bucket=app.config["AWS_S3_RESULTS_BUCKET"], Key=job['s3_key_log_file'])
-        content = response['Body'].read().decode('utf-8')
-    
-    except KeyError:
-        app.logger.exception(f'log file not found: {id}')
+    key = job.get('s3_key_log_file')
+    if not key:
+        app.logger.error(f'log file not found: {id}')
         return abort(404)
-        
+    bucket = app.config["AWS_S3_RESULTS_BUCKET"]
+
+    # ?offset= pages forward from a byte, ?tail= shows the last N KB,
+    # ?raw=1 streams the log as text/plain (gzip-compressed if the client accepts it);
+    # with none of offset, tail or limit the whole log is shown
+    paged = any(name in request.args for name in ('offset', 'tail', 'limit'))
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        tail = request.args.get('tail')
+        tail = max(1, int(tail)) * 1024 if tail else None
+        limit = min(LOG_MAX_PAGE_KB, max(1, int(request.args.get('limit', LOG_PAGE_KB)))) * 1024 if paged else None
+    except ValueError:
+        return abort(400)
+    raw = request.args.get('raw') == '1'
+
+    try:
+        size = object_size(s3, bucket, key)
+        start, end = page_range(size, offset, tail, None if raw else limit)
+
+        if raw:
+            body = open_range(s3, bucket, key, start, end)
+        else:
+            content, start = read_page(s3, bucket, key, start, end, skip_partial_line=tail is not None)
+
     except ClientError as ce:
+        if ce.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            app.logger.error(f'log file not found: {id}')
+            return abort(404)
         app.logger.exception(f'error when reading log: {id}')
         return abort(500)
 
@@ -335,7 +744,21 @@ def annotation_log(id):
         app.logger.exception(f'error when reading log: {id}')
         return abort(500)
 
-    return render_template("view_log.html", job_id = job['job_id'], content = content)
+    if raw:
+        chunks = iter_body(body)
+        headers = {'Cache-Control': 'private, no-store'}
+        if LOG_GZIP and 'gzip' in request.accept_encodings:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+        else:
+            headers['Content-Length'] = str(end - start)
+        return Response(stream_with_context(chunks), mimetype='text/plain', headers=headers)
+
+    return render_template("view_log.html", job_id = job['job_id'], content = content,
+                           offset = start, size = size, limit_kb = limit // 1024 if limit else None,
+                           prev_offset = max(0, start - limit) if limit and start > 0 else None,
+                           next_offset = end if end < size else None)
 
 """Subscription management handler
 """
@@ -0,0 +1,248 @@
+# warm_pool.py
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Pool of pre-initialised AnnTools workers, used instead of starting a fresh
+# `python run.py` for every job
+##
+
+import multiprocessing
+import os
+import queue
+import resource
+import runpy
+import signal
+import sys
+import threading
+import time
+import traceback
+
+'''
+reference:
+    1. multiprocessing pool: https://docs.python.org/3/library/multiprocessing.html#module-multiprocessing.pool
+    2. forkserver preload: https://docs.python.org/3/library/multiprocessing.html#multiprocessing.set_forkserver_preload
+    3. runpy: https://docs.python.org/3/library/runpy.html#runpy.run_path
+'''
+
+class JobTimeout(BaseException):
+    '''
+    Raised by SIGALRM inside the job. A BaseException, like KeyboardInterrupt,
+    so `except Exception` in run.py or anntools cannot swallow it and report
+    a timed out job as a success. The signal is only handled between Python
+    bytecodes, so a long C call is not interrupted; WarmPool's watchdog
+    kills such a worker kill_grace seconds later.
+    '''
+
+#where a worker reports each job it starts, for the watchdog
+_started = None
+
+def _on_alarm(signum, frame):
+    raise JobTimeout()
+
+def _warm_up(paths, preload, started=None):
+    #runs once per worker; modules already imported by the forkserver are free
+    global _started
+    _started = started
+    for path in paths:
+        if path not in sys.path:
+            sys.path.append(path)
+
+    for name in preload:
+        __import__(name)
+
+    signal.signal(signal.SIGALRM, _on_alarm)
+
+def _run_job(script, filename, job_id, timeout):
+    '''
+    Run the AnnTools script in this already warm worker
+    output:
+        record: resource usage of this job, same shape as the supervisor's
+    '''
+    start = time.time()
+    if _started is not None:
+        _started.put((job_id, os.getpid()))
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    argv = sys.argv
+    sys.argv = [script, filename, job_id]
+    timed_out = False
+    signal.alarm(timeout)
+
+    try:
+        runpy.run_path(script, run_name='__main__')
+        returncode = 0
+
+    except SystemExit as se:
+        returncode = se.code if isinstance(se.code, int) else (0 if se.code is None else 1)
+
+    except JobTimeout:
+        print(f'anntools for {job_id} exceeded {timeout}s, aborted')
+        timed_out, returncode = True, -signal.SIGALRM
+
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+
+    finally:
+        signal.alarm(0)
+        sys.argv = argv
+
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+
+    #ru_maxrss is the worker's peak so far, which is an upper bound for this job
+    return {'job_id': job_id,
+            'pid': os.getpid(),
+            'returncode': returncode,
+            'timed_out': timed_out,
+            'wall_time': round(time.time() - start, 3),
+            'cpu_time': round(cpu_time, 3),
+            'max_rss_kb': after.ru_maxrss}
+
+
+class WarmJob:
+    '''
+    Handle for one job on the warm pool, waits like supervisor.Child
+    '''
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.record = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.record
+
+
+class WarmPool:
+    '''
+    Keeps `workers` processes with anntools already imported and hands them
+    jobs by file path. Workers are replaced after `max_jobs` jobs so leaks in
+    anntools or its reference data do not build up.
+    input:
+        workers: number of worker processes
+        max_jobs: jobs per worker before it is recycled, 0 to never recycle
+        script: AnnTools entry script run for each job
+        preload: modules to import before the first job
+        paths: directories added to sys.path before preloading
+        timeout: seconds before a job is aborted, 0 for no limit
+        supervisor: optional AnnSupervisor that keeps the job records
+        kill_grace: seconds past timeout before the watchdog kills a worker
+                    whose job did not stop (stuck in a C call); the pool
+                    replaces the worker and the job is reported timed out
+    '''
+    def __init__(self, workers, max_jobs=0, script='run.py', preload=(), paths=(),
+                 timeout=0, supervisor=None, kill_grace=30):
+        for path in paths:
+            if path not in sys.path:
+                sys.path.append(path)
+
+        #the forkserver does not apply our sys.path before preloading (3.11),
+        #so hand it the anntools directories through the environment
+        if paths:
+            pythonpath = [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+            os.environ['PYTHONPATH'] = os.pathsep.join(pythonpath + [p for p in paths if p not in pythonpath])
+
+        #the forkserver imports anntools once; every worker, including recycled
+        #ones, is forked from it already warm and without the annotator's threads
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(list(preload))
+        self.workers = workers
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.script = os.path.abspath(script)
+        self.timeout = timeout
+        self.supervisor = supervisor
+        self.kill_grace = kill_grace
+        #job_id -> its finish callback, until the job is reported
+        self.jobs = {}
+        self.watchdog = None
+        self.started = ctx.Queue() if timeout else None
+        self.pool = ctx.Pool(processes=workers,
+                             initializer=_warm_up,
+                             initargs=(list(paths), list(preload), self.started),
+                             maxtasksperchild=max_jobs or None)
+
+    def submit(self, filename, job_id, on_exit=None):
+        '''
+        Queue one job; returns immediately with a WarmJob handle
+        '''
+        job = WarmJob(job_id)
+
+        def finish(record):
+            with self.lock:
+                #the watchdog may have reported it already
+                if self.jobs.get(job_id) is not finish:
+                    return
+                del self.jobs[job_id]
+                self.in_flight -= 1
+            job.record = record
+            if self.supervisor:
+                self.supervisor.add_record(record)
+            job.done.set()
+            if on_exit:
+                try:
+                    on_exit(record)
+                except Exception as e:
+                    print(f'Unexpected error in exit callback for {job_id}: {e}')
+
+        def fail(e):
+            print(f'Fail to run anntools for {job_id}: {e}')
+            finish({'job_id': job_id, 'pid': None, 'returncode': 1, 'timed_out': False,
+                    'wall_time': None, 'cpu_time': None, 'max_rss_kb': None})
+
+        with self.lock:
+            self.in_flight += 1
+            self.jobs[job_id] = finish
+            #the watchdog starts with the first job
+            if self.started is not None and self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._watch, daemon=True)
+                self.watchdog.start()
+        self.pool.apply_async(_run_job, (self.script, filename, job_id, self.timeout),
+                              callback=finish, error_callback=fail)
+        return job
+
+    def _watch(self):
+        #job_id -> (pid, started) of jobs running in a worker
+        running = {}
+        while True:
+            try:
+                job_id, pid = self.started.get(timeout=1)
+                #a worker runs one job at a time, so its earlier job is over
+                for other, (other_pid, _) in list(running.items()):
+                    if other_pid == pid:
+                        del running[other]
+                running[job_id] = (pid, time.time())
+            except queue.Empty:
+                pass
+
+            now = time.time()
+            for job_id, (pid, started) in list(running.items()):
+                with self.lock:
+                    finish = self.jobs.get(job_id)
+                if finish is None:
+                    del running[job_id]
+                    continue
+                if now - started < self.timeout + self.kill_grace:
+                    continue
+
+                del running[job_id]
+                print(f'anntools for {job_id} did not stop {self.kill_grace}s after its {self.timeout}s timeout, '
+                      f'killing worker {pid}')
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                #the pool replaces the killed worker, but never reports its job
+                finish({'job_id': job_id, 'pid': pid, 'returncode': -signal.SIGKILL, 'timed_out': True,
+                        'wall_time': round(now - started, 3), 'cpu_time': None, 'max_rss_kb': None})
+
+    def free(self):
+        #idle workers; jobs beyond that queue inside the pool
+        with self.lock:
+            return max(0, self.workers - self.in_flight)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+### EOF